@@ -0,0 +1,118 @@
+# Usage: python3 backfill.py --region <REGION> --account <ACCOUNT_ID> [--workers <N>] [--dry-run] <DIRECTORY>
+# Example: KFUSE_ENDPOINT=https://<kfuse-host>/ingester KF_API_KEY=<key> \
+#   python3 backfill.py --region us-east-1 --account 123456789012 --workers 8 ./exported-flowlogs
+#
+# Replays archived VPC flow logs through the same aggregation as the Lambda.
+# DIRECTORY is searched recursively for:
+#   - CloudWatch Logs exports to S3 (gzipped lines of "<ISO timestamp> <message>")
+#   - S3-delivered flow log objects (text with a header line, gzipped or not,
+#     and .parquet)
+# Files are sharded across a process pool, every worker aggregates its files
+# into its own Stats and the parent merges them before flushing once.
+import argparse
+import gzip
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import vpc_flowlog_lambda as lambda_module
+
+
+def _is_cloudwatch_export(fileobj):
+    head = fileobj.peek(64)
+    if head[:2] == b"\x1f\x8b":
+        head = gzip.GzipFile(fileobj=fileobj).read(64)
+        fileobj.seek(0)
+    first = head.split(b" ", 1)[0]
+    return first[:2] in (b"19", b"20") and first.endswith(b"Z")
+
+
+def process_cloudwatch_export(fileobj, tags, batch_records=lambda_module.KF_S3_BATCH_RECORDS):
+    records = 0
+    batch = lambda_module.FlowLogBatch()
+    for line in lambda_module._flow_log_text_lines(fileobj):
+        timestamp, message = line.split(" ", 1)
+        timestamp = datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+        batch.process_message(message, timestamp)
+        records += 1
+        if records % batch_records == 0:
+            lambda_module.emit_batch(batch, tags)
+            batch = lambda_module.FlowLogBatch()
+    lambda_module.emit_batch(batch, tags)
+    return records
+
+
+def aggregate_files(paths, tags):
+    # Runs in a worker process: aggregates the files into the worker's
+    # module-level Stats and returns it without flushing, whatever the
+    # KF_FLUSH_MAX_* thresholds: the parent merges and flushes once. A worker
+    # runs several shards, so the Stats is emptied first and every shard
+    # returns only its own aggregates.
+    lambda_module.stats._initialize()
+    lambda_module.stats.flush_max_points = lambda_module.stats.flush_max_series = 0
+    records = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as fileobj:
+            if not path.endswith(".parquet") and _is_cloudwatch_export(fileobj):
+                records += process_cloudwatch_export(fileobj, tags)
+            else:
+                records += lambda_module.process_flow_log_object(fileobj, path, tags)
+    return lambda_module.stats, records, time.perf_counter() - start
+
+
+def find_files(directory):
+    paths = []
+    for root, _, names in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in names if not name.startswith("."))
+    return sorted(paths)
+
+
+def shard(paths, shards):
+    # round robin over the files sorted by size, so shards get similar work
+    paths = sorted(paths, key=os.path.getsize, reverse=True)
+    return [paths[i::shards] for i in range(shards) if paths[i::shards]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill archived VPC flow logs through the flow log Lambda aggregation")
+    parser.add_argument("directory", help="Directory of exported or S3-delivered flow log files")
+    parser.add_argument("--region", required=True, help="Value of the region tag")
+    parser.add_argument("--account", required=True, help="Value of the aws_account tag")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--shards-per-worker", type=int, default=4,
+                        help="File shards queued per worker, for load balancing")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Aggregate only, do not submit to Kloudfuse")
+    args = parser.parse_args()
+
+    tags = ["region:%s" % args.region, "aws_account:%s" % args.account]
+    paths = find_files(args.directory)
+    if not paths:
+        raise SystemExit("No files found in %s" % args.directory)
+    shards = shard(paths, args.workers * args.shards_per_worker)
+    print(f"Backfilling {len(paths)} files in {len(shards)} shards on {args.workers} workers")
+
+    start = time.perf_counter()
+    total_records = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(aggregate_files, paths, tags) for paths in shards]
+        for future in as_completed(futures):
+            worker_stats, records, seconds = future.result()
+            lambda_module.stats.merge(worker_stats)
+            total_records += records
+            print(f"  shard done: {records} records in {seconds:.1f}s "
+                  f"({records / max(seconds, 1e-9):.0f} records/s)")
+    aggregated = time.perf_counter() - start
+    print(f"Aggregated {total_records} records in {aggregated:.1f}s "
+          f"({total_records / max(aggregated, 1e-9):.0f} records/s)")
+
+    if args.dry_run:
+        series = len(lambda_module.stats.series_keys)
+        print(f"Dry run, not submitting {series} series")
+    else:
+        lambda_module.stats.flush(tags)
+        print(f"Submitted in {time.perf_counter() - start - aggregated:.1f}s")
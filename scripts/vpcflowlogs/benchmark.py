@@ -0,0 +1,288 @@
+# Usage: python3 benchmark.py decode [--events <N>] [--repeat <N>]
+#        python3 benchmark.py serialize [--points <N>] [--points-per-series <N>] [--repeat <N>]
+#        python3 benchmark.py pipeline [--events <N>] [--batches <N>] [--enis <N>] [--ips <N>]
+#                                      [--ports <N>] [--mix <FORMAT:WEIGHT,...>] [--repeat <N>]
+#                                      [--min-records-per-sec <N>] [--max-peak-mb <N>]
+#                                      [--max-payload-bytes <N>] [--max-series <N>]
+# Example: python3 benchmark.py decode --events 20000 --repeat 10
+# Example: python3 benchmark.py serialize --points 100000
+# Example: python3 benchmark.py pipeline --events 50000 --enis 200 --ips 5000 --min-records-per-sec 100000
+#
+# pipeline runs synthetic CloudWatch Logs batches through the Lambda's decode,
+# parse, aggregate and serialize stages with a no-op sender, nothing leaves
+# the machine. With any of the threshold options it exits non-zero when a
+# threshold is missed, so it can gate CI.
+import argparse
+import os
+import random
+import time
+import tracemalloc
+
+# the no-op sender never uses the key, but flush resolves it
+os.environ.setdefault("KF_API_KEY", "benchmark")
+
+import agent_payload_pb2 as Pb
+import vpc_flowlog_lambda as lambda_module
+from flowlog_generator import FORMATS, FlowLogGenerator, cloudwatch_payload
+
+STAGES = ("decode", "parse", "aggregate", "serialize")
+TAGS = ["region:us-east-1", "aws_account:123456789012"]
+
+
+def bench_decode(events, repeat):
+    data = cloudwatch_payload(FlowLogGenerator(enis=16, ips=65536).messages(events))
+    print(f"{events} events, {len(data)} bytes compressed")
+    backends = ["json"]
+    if lambda_module.orjson is not None:
+        backends.append("orjson")
+    if lambda_module.msgspec is not None:
+        backends.append("msgspec")
+
+    baseline = None
+    for backend in backends:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in lambda_module.iter_log_events(data, backend=backend):
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        baseline = baseline or best
+        print(
+            f"{backend:>8}: {best * 1000:8.2f}ms  {events / best:12.0f} events/s  "
+            f"{baseline / best:5.2f}x"
+        )
+
+
+def synthetic_series(points, points_per_series, seed=0):
+    # (metric, tag set, points) shaped like the Lambda's counter and
+    # percentile series: a few metrics over many tag sets, one point per
+    # rolled up timestamp
+    rnd = random.Random(seed)
+    metrics = ["aws.vpc.flowlogs.%s" % name for name in (
+        "action", "bytes.total", "packets.total", "bytes.per_request.p99")]
+    series = []
+    for i in range(points // points_per_series):
+        tag_set = lambda_module.tag_set_key([
+            "interface_id:eni-%08x" % (i % 500), "protocol:TCP", "ip:10.0.0.%d" % (i % 250),
+            "action:ACCEPT", "region:us-east-1", "aws_account:123456789012",
+            "direction:inbound" if i % 2 else "direction:outbound",
+        ])
+        values = [rnd.randint(0, 10**6) if i % 3 else rnd.random() * 1500
+                  for _ in range(points_per_series)]
+        series.append((metrics[i % len(metrics)], tag_set,
+                       list(zip(range(1700000000, 1700000000 + points_per_series), values))))
+    return series
+
+
+def protobuf_payload(series):
+    # How Stats.flush built its MetricPayload before SeriesEncoder: a message
+    # object per series and point, and the tag set split for every series.
+    payload = Pb.MetricPayload()
+    for metric, tag_set, points in series:
+        s = Pb.MetricPayload.MetricSeries()
+        s.metric = metric
+        s.tags.extend(tag_set.split(","))
+        for point in points:
+            p = Pb.MetricPayload.MetricPoint()
+            p.timestamp = point[0]
+            p.value = point[1]
+            s.points.append(p)
+        payload.series.append(s)
+    return payload.SerializeToString()
+
+
+def encoded_payload(series):
+    payload = lambda_module.SeriesEncoder()
+    for metric, tag_set, points in series:
+        payload.add(metric, tag_set, points)
+    return payload.chunks(max_bytes=float("inf"))[0]
+
+
+def bench_serialize(points, points_per_series, repeat):
+    series = synthetic_series(points, points_per_series)
+    print(f"{len(series)} series of {points_per_series} points")
+    expected = None
+    baseline = None
+    for name, build in (("protobuf", protobuf_payload), ("encoder", encoded_payload)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = build(series)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if expected is None:
+            expected = data
+        elif data != expected:
+            raise SystemExit(f"{name} payload differs from the protobuf one")
+        baseline = baseline or best
+        print(
+            f"{name:>9}: {best * 1000:9.2f}ms  {points / best:12.0f} points/s  "
+            f"{len(data)} bytes  {baseline / best:5.2f}x"
+        )
+
+
+class NoopSender(object):
+    # Stands in for submit_chunks: compresses every chunk the way
+    # submit_chunk would, keeps it and reports success.
+    def __init__(self):
+        self.chunks = []
+        self.wire_bytes = 0
+
+    def __call__(self, chunks, concurrency=None):
+        for url, data in chunks:
+            self.wire_bytes += len(lambda_module.compress_payload(data, lambda_module.compression))
+            self.chunks.append((url, data))
+        return []
+
+    def series(self):
+        count = 0
+        for url, data in self.chunks:
+            if "sketches" in url:
+                count += len(Pb.SketchPayload.FromString(data).sketches)
+            else:
+                count += len(Pb.MetricPayload.FromString(data).series)
+        return count
+
+
+def run_pipeline(payloads):
+    # One pass over the (LogFormat, payload) batches, decode and parse are
+    # timed separately by materializing the decoded events (the handler
+    # streams one into the other).
+    timings = dict.fromkeys(STAGES, 0.0)
+    records = 0
+    for log_format, data in payloads:
+        start = time.perf_counter()
+        log_events = list(lambda_module.iter_log_events(data))
+        decoded = time.perf_counter()
+        batch = lambda_module.FlowLogBatch(log_format=log_format)
+        for message, timestamp in log_events:
+            batch.process_message(message, timestamp / 1000)
+        parsed = time.perf_counter()
+        lambda_module.emit_batch(batch, TAGS)
+        aggregated = time.perf_counter()
+        lambda_module.stats.flush(TAGS)
+        flushed = time.perf_counter()
+
+        records += len(log_events)
+        timings["decode"] += decoded - start
+        timings["parse"] += parsed - decoded
+        timings["aggregate"] += aggregated - parsed
+        timings["serialize"] += flushed - aggregated
+    return records, timings
+
+
+def bench_pipeline(args):
+    # A batch is parsed with a single LogFormat, like a flow log subscription
+    # delivers one, so every batch gets one format of the mix.
+    generator = FlowLogGenerator(args.enis, args.ips, args.ports, args.mix, seed=args.seed)
+    formats = generator.batch_formats(args.batches)
+    log_formats = {fmt: lambda_module.LogFormat(FORMATS[fmt]) for fmt in set(formats)}
+    payloads = [
+        (log_formats[fmt], cloudwatch_payload(generator.messages(args.events, fmt)))
+        for fmt in formats
+    ]
+    print(
+        f"{args.batches} batches of {args.events} events ({args.enis} ENIs, {args.ips} peers, "
+        f"{args.ports} ports, formats {', '.join(formats)}), "
+        f"{sum(len(data) for _, data in payloads)} bytes compressed"
+    )
+
+    best = None
+    for _ in range(args.repeat):
+        sender = NoopSender()
+        lambda_module.submit_chunks = sender
+        records, timings = run_pipeline(payloads)
+        if best is None or sum(timings.values()) < sum(best.values()):
+            best, best_sender = timings, sender
+
+    sender = NoopSender()
+    lambda_module.submit_chunks = sender
+    tracemalloc.start()
+    run_pipeline(payloads)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = sum(best.values())
+    result = {
+        "records_per_sec": records / total,
+        "peak_mb": peak / 2**20,
+        "payload_bytes": best_sender.wire_bytes,
+        "series": best_sender.series(),
+    }
+    for stage in STAGES:
+        print(f"{stage:>10}: {best[stage] * 1000:9.2f}ms  {best[stage] / total:6.1%}")
+    print(f"{'total':>10}: {total * 1000:9.2f}ms  {result['records_per_sec']:.0f} records/s")
+    print(f"peak traced memory {result['peak_mb']:.1f} MiB, "
+          f"{len(best_sender.chunks)} chunks of {result['payload_bytes']} bytes "
+          f"({lambda_module.compression}), {result['series']} series")
+    return result
+
+
+def check_thresholds(result, min_records_per_sec=None, max_peak_mb=None,
+                     max_payload_bytes=None, max_series=None):
+    # Returns a line per missed threshold, None thresholds are not checked.
+    failures = []
+    if min_records_per_sec is not None and result["records_per_sec"] < min_records_per_sec:
+        failures.append(f"records/s {result['records_per_sec']:.0f} < {min_records_per_sec}")
+    if max_peak_mb is not None and result["peak_mb"] > max_peak_mb:
+        failures.append(f"peak memory {result['peak_mb']:.1f} MiB > {max_peak_mb} MiB")
+    if max_payload_bytes is not None and result["payload_bytes"] > max_payload_bytes:
+        failures.append(f"payload bytes {result['payload_bytes']} > {max_payload_bytes}")
+    if max_series is not None and result["series"] > max_series:
+        failures.append(f"series {result['series']} > {max_series}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the VPC flow log Lambda")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    decode = subparsers.add_parser(
+        "decode", help="Time CloudWatch Logs payload decoding per JSON backend")
+    decode.add_argument("--events", type=int, default=20000,
+                        help="Log events per batch")
+    decode.add_argument("--repeat", type=int, default=5,
+                        help="Runs per backend, the best one is reported")
+
+    serialize = subparsers.add_parser(
+        "serialize", help="Time building a MetricPayload, protobuf messages vs SeriesEncoder")
+    serialize.add_argument("--points", type=int, default=100000, help="Points in the payload")
+    serialize.add_argument("--points-per-series", type=int, default=10)
+    serialize.add_argument("--repeat", type=int, default=3,
+                           help="Runs per builder, the best one is reported")
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="Time every stage of the Lambda on synthetic batches")
+    pipeline.add_argument("--events", type=int, default=20000,
+                          help="Log events per batch")
+    pipeline.add_argument("--batches", type=int, default=5,
+                          help="Batches (invocations) per run")
+    pipeline.add_argument("--enis", type=int, default=10, help="Distinct interfaces")
+    pipeline.add_argument("--ips", type=int, default=1000, help="Distinct peer addresses")
+    pipeline.add_argument("--ports", type=int, default=10, help="Distinct service ports")
+    pipeline.add_argument("--mix", default="default:1",
+                          help="Formats of the batches and their weights, one of %s, "
+                               "e.g. default:0.9,v2:0.1" % ", ".join(FORMATS))
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument("--repeat", type=int, default=3,
+                          help="Runs, the fastest one is reported")
+    pipeline.add_argument("--min-records-per-sec", type=float)
+    pipeline.add_argument("--max-peak-mb", type=float)
+    pipeline.add_argument("--max-payload-bytes", type=int)
+    pipeline.add_argument("--max-series", type=int)
+    args = parser.parse_args()
+
+    if args.command == "decode":
+        bench_decode(args.events, args.repeat)
+    elif args.command == "serialize":
+        bench_serialize(args.points, args.points_per_series, args.repeat)
+    elif args.command == "pipeline":
+        result = bench_pipeline(args)
+        failures = check_thresholds(
+            result, args.min_records_per_sec, args.max_peak_mb,
+            args.max_payload_bytes, args.max_series)
+        for failure in failures:
+            print(f"FAILED {failure}")
+        if failures:
+            raise SystemExit(1)
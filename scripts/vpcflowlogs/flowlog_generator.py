@@ -0,0 +1,183 @@
+# Usage: python3 flowlog_generator.py [--records <N>] [--enis <N>] [--ips <N>] [--ports <N>]
+#                                     [--mix <FORMAT:WEIGHT,...>] [--output-format event|s3] <OUTPUT>
+# Example: python3 flowlog_generator.py --records 100000 --enis 50 --mix default:0.9,v2:0.1 event.json
+#
+# Synthetic VPC flow log records with controllable cardinality, for the
+# benchmarks and for exercising the Lambda, S3 and backfill entry points
+# offline. The same seed always produces the same records. The Lambda parses
+# a single KF_LOG_FORMAT, records of the other formats of a mix count as
+# unsupported, and an S3 object holds one format.
+import argparse
+import base64
+import gzip
+import json
+import random
+
+# LogFormats the generator can emit, "default" is the Lambda's default format.
+FORMATS = {
+    "default": "${version} ${account-id} ${interface-id} ${srcaddr} ${dstaddr} "
+    "${srcport} ${dstport} ${protocol} ${packets} ${bytes} ${start} ${end} "
+    "${action} ${log-status} ${vpc-id}",
+    "v2": "${version} ${account-id} ${interface-id} ${srcaddr} ${dstaddr} "
+    "${srcport} ${dstport} ${protocol} ${packets} ${bytes} ${start} ${end} "
+    "${action} ${log-status}",
+    "v5": "${version} ${account-id} ${interface-id} ${srcaddr} ${dstaddr} "
+    "${srcport} ${dstport} ${protocol} ${packets} ${bytes} ${start} ${end} "
+    "${action} ${log-status} ${vpc-id} ${subnet-id} ${instance-id} ${tcp-flags} "
+    "${type} ${pkt-srcaddr} ${pkt-dstaddr} ${region} ${az-id} ${sublocation-type} "
+    "${sublocation-id} ${pkt-src-aws-service} ${pkt-dst-aws-service} "
+    "${flow-direction} ${traffic-path}",
+}
+VERSIONS = {"default": "3", "v2": "2", "v5": "5"}
+
+
+def parse_mix(mix):
+    # "default:0.9,v2:0.1" -> {"default": 0.9, "v2": 0.1}
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        if name not in FORMATS:
+            raise ValueError("Unknown format %r, expected one of %s" % (name, ", ".join(FORMATS)))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class FlowLogGenerator(object):
+    # enis interfaces, each with its own private address, talk to a pool of
+    # ips peers on ports well-known ports. nodata is the share of NODATA and
+    # SKIPDATA records.
+    def __init__(self, enis=10, ips=100, ports=10, mix="default:1", nodata=0.02,
+                 start=1700000000, seed=0):
+        self.rnd = random.Random(seed)
+        self.enis = ["eni-%08x" % i for i in range(enis)]
+        self.eni_ips = ["10.0.%d.%d" % (i // 250, i % 250 + 2) for i in range(enis)]
+        self.peers = ["10.%d.%d.%d" % (1 + i // 62500, i // 250 % 250, i % 250 + 2)
+                      for i in range(ips)]
+        self.ports = [443, 80, 22, 53, 3306, 5432, 6379, 8080, 9092, 27017][:ports]
+        self.ports += [10000 + i for i in range(max(0, ports - len(self.ports)))]
+        weights = parse_mix(mix)
+        self.formats = list(weights)
+        self.weights = [weights[name] for name in self.formats]
+        self.nodata = nodata
+        self.time = start
+
+    def record(self, fmt=None):
+        # one (message, CloudWatch timestamp in ms) pair, in the given format
+        # or one drawn from the mix
+        rnd = self.rnd
+        if fmt is None:
+            fmt = rnd.choices(self.formats, self.weights)[0]
+        i = rnd.randrange(len(self.enis))
+        eni, local = self.enis[i], self.eni_ips[i]
+        peer = rnd.choice(self.peers)
+        port = rnd.choice(self.ports)
+        ephemeral = rnd.randint(1024, 65535)
+        outbound = rnd.random() < 0.5
+        self.time += rnd.random() * 0.01
+        start = int(self.time)
+        end = start + rnd.randint(0, 60)
+
+        status = "OK"
+        if rnd.random() < self.nodata:
+            status = rnd.choice(("NODATA", "SKIPDATA"))
+        if status == "OK":
+            packets = rnd.randint(1, 1000)
+            values = {
+                "srcaddr": local if outbound else peer,
+                "dstaddr": peer if outbound else local,
+                "srcport": str(ephemeral if outbound else port),
+                "dstport": str(port if outbound else ephemeral),
+                "protocol": rnd.choice(("6", "6", "6", "17", "1")),
+                "packets": str(packets),
+                "bytes": str(packets * rnd.randint(40, 1500)),
+                "action": "ACCEPT" if rnd.random() < 0.95 else "REJECT",
+                "tcp-flags": rnd.choice(("2", "18", "19", "3")),
+                "flow-direction": "egress" if outbound else "ingress",
+            }
+        else:
+            values = {}
+        values.update(
+            version=VERSIONS[fmt],
+            start=str(start),
+            end=str(end),
+            **{"log-status": status, "account-id": "123456789012", "interface-id": eni,
+               "vpc-id": "vpc-0a1b2c3d", "subnet-id": "subnet-%d" % (i % 4),
+               "instance-id": "i-%08x" % i, "type": "IPv4", "region": "us-east-1",
+               "az-id": "use1-az%d" % (i % 4 + 1)},
+        )
+        values.setdefault("pkt-srcaddr", values.get("srcaddr", "-"))
+        values.setdefault("pkt-dstaddr", values.get("dstaddr", "-"))
+        names = FORMATS[fmt][2:-1].split("} ${")
+        return " ".join(values.get(name, "-") for name in names), end * 1000
+
+    def messages(self, count, fmt=None):
+        return [self.record(fmt) for _ in range(count)]
+
+    def batch_formats(self, batches):
+        # one format per batch, in proportion to the mix weights
+        total = sum(self.weights)
+        formats = []
+        for i in range(batches):
+            position = (i + 0.5) / batches * total
+            for fmt, weight in zip(self.formats, self.weights):
+                if position < weight:
+                    break
+                position -= weight
+            formats.append(fmt)
+        return formats
+
+
+def cloudwatch_payload(records):
+    # the gzipped CloudWatch Logs document for (message, timestamp) records
+    log_events = [
+        {"id": str(i), "timestamp": timestamp, "message": message}
+        for i, (message, timestamp) in enumerate(records)
+    ]
+    document = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "vpc-flowlogs",
+        "logStream": "eni-00000000-all",
+        "subscriptionFilters": ["kloudfuse"],
+        "logEvents": log_events,
+    }
+    return gzip.compress(json.dumps(document, separators=(",", ":")).encode())
+
+
+def cloudwatch_event(records):
+    # the event the Lambda receives from a CloudWatch Logs subscription
+    data = base64.b64encode(cloudwatch_payload(records)).decode()
+    return {"awslogs": {"data": data}}
+
+
+def s3_object(records, log_format=FORMATS["default"]):
+    # an S3-delivered, gzipped text flow log object
+    header = log_format.replace("${", "").replace("}", "")
+    lines = [header] + [message for message, _ in records]
+    return gzip.compress(("\n".join(lines) + "\n").encode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic VPC flow logs")
+    parser.add_argument("output", help="File to write")
+    parser.add_argument("--records", type=int, default=10000, help="Number of records")
+    parser.add_argument("--enis", type=int, default=10, help="Distinct interfaces")
+    parser.add_argument("--ips", type=int, default=100, help="Distinct peer addresses")
+    parser.add_argument("--ports", type=int, default=10, help="Distinct service ports")
+    parser.add_argument("--mix", default="default:1",
+                        help="Record formats and their weights, e.g. default:0.9,v2:0.1")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-format", choices=("event", "s3"), default="event",
+                        help="Lambda CloudWatch Logs event (JSON) or S3 object (gzipped text)")
+    args = parser.parse_args()
+
+    generator = FlowLogGenerator(args.enis, args.ips, args.ports, args.mix, seed=args.seed)
+    if args.output_format == "s3" and len(generator.formats) > 1:
+        raise SystemExit("An S3 object holds a single format, got --mix %s" % args.mix)
+    records = generator.messages(args.records)
+    if args.output_format == "event":
+        with open(args.output, "w") as f:
+            json.dump(cloudwatch_event(records), f)
+    else:
+        with open(args.output, "wb") as f:
+            f.write(s3_object(records, FORMATS[generator.formats[0]]))
@@ -4,24 +4,174 @@ import gzip
 import json
 import time
 import base64
-from io import BufferedReader, BytesIO
+import codecs
+import math
+import re
+import zlib
+import io
+import itertools
+import heapq
+import threading
+import csv
+import ipaddress
+import struct
+from array import array
+from functools import lru_cache
+from operator import itemgetter
 from collections import defaultdict, Counter
-from urllib.request import Request, urlopen
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from http.client import (
+    HTTPConnection,
+    HTTPException,
+    HTTPSConnection,
+    RemoteDisconnected,
+)
+from urllib.error import HTTPError
+from urllib.parse import unquote_plus, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
-import boto3
-import botocore
 import agent_payload_pb2 as Pb
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger()
 logger.setLevel(logging.getLevelName(os.environ.get("KF_LOG_LEVEL", "INFO").upper()))
 logger.info("Loading function")
+init_started = time.perf_counter()
 
 KFUSE_ENDPOINT = os.getenv("KFUSE_ENDPOINT", default="<TBA>")
+# "percentiles" submits min/median/p90/p95/p99/max series per histogram,
+# "exact" submits the same series with nearest-rank indexing, both computed
+# in one batch over typed arrays (vectorized when numpy is available), and
+# "sketch" submits mergeable DDSketch distributions as a SketchPayload.
+KF_HISTOGRAM_MODE = os.getenv("KF_HISTOGRAM_MODE", default="percentiles").lower()
+# Payloads are split into chunks of at most this many serialized bytes, each
+# chunk is compressed with KF_COMPRESSION (none, gzip or zstd) and up to
+# KF_SEND_CONCURRENCY chunks are submitted at the same time.
+KF_MAX_PAYLOAD_BYTES = int(os.getenv("KF_MAX_PAYLOAD_BYTES", default=2 * 1024 * 1024))
+KF_COMPRESSION = os.getenv("KF_COMPRESSION", default="none").lower()
+KF_SEND_CONCURRENCY = int(os.getenv("KF_SEND_CONCURRENCY", default=4))
+KF_HTTP_TIMEOUT = float(os.getenv("KF_HTTP_TIMEOUT", default=30))
+# JSON decoder for CloudWatch Logs payloads: msgspec, orjson or json. "auto"
+# picks the fastest one that is installed.
+KF_JSON_BACKEND = os.getenv("KF_JSON_BACKEND", default="auto").lower()
+# Resolved Kloudfuse keys are cached for this many seconds.
+KF_CREDENTIALS_TTL = float(os.getenv("KF_CREDENTIALS_TTL", default=3600))
+# Chunks that fail with a retryable error are spilled to this directory, up to
+# KF_SPILL_MAX_BYTES, and replayed by later flushes of the warm container with
+# exponential backoff starting at KF_SPILL_BACKOFF seconds, in the time an
+# invocation has left beyond KF_FLUSH_RESERVE_MS. An empty
+# KF_SPILL_DIR disables spilling and failures are raised instead.
+KF_SPILL_DIR = os.getenv("KF_SPILL_DIR", default="/tmp/kfuse-spill")
+KF_SPILL_MAX_BYTES = int(os.getenv("KF_SPILL_MAX_BYTES", default=64 * 1024 * 1024))
+KF_SPILL_BACKOFF = float(os.getenv("KF_SPILL_BACKOFF", default=5))
+# LogFormat of the flow log subscription, as configured on the flow log. The
+# default is the version 2 format followed by ${vpc-id}.
+KF_LOG_FORMAT = os.getenv(
+    "KF_LOG_FORMAT",
+    default="${version} ${account-id} ${interface-id} ${srcaddr} ${dstaddr} "
+    "${srcport} ${dstport} ${protocol} ${packets} ${bytes} ${start} ${end} "
+    "${action} ${log-status} ${vpc-id}",
+)
+# S3-delivered flow log objects are read in ranged GETs of this many bytes and
+# aggregated in batches of KF_S3_BATCH_RECORDS records, as are CloudWatch Logs
+# deliveries larger than that. KF_S3_ENDPOINT_URL
+# points the S3 client at a local stand-in such as MinIO.
+KF_S3_RANGE_BYTES = int(os.getenv("KF_S3_RANGE_BYTES", default=8 * 1024 * 1024))
+KF_S3_BATCH_RECORDS = int(os.getenv("KF_S3_BATCH_RECORDS", default=100000))
+KF_S3_ENDPOINT_URL = os.getenv("KF_S3_ENDPOINT_URL")
+# Datapoints are rolled up into buckets of this many seconds, aligned to
+# multiples of the interval, as they are recorded.
+KF_ROLLUP_INTERVAL = int(os.getenv("KF_ROLLUP_INTERVAL", default=1))
+if KF_ROLLUP_INTERVAL < 1:
+    raise ValueError(
+        "KF_ROLLUP_INTERVAL must be at least 1 second, got %r" % KF_ROLLUP_INTERVAL
+    )
+# Maximum number of flow tag sets (interface, protocol, action, direction and
+# subnet map tags) kept per flush, the ones carrying the most bytes win and the rest are folded
+# into a single "other" tag set. 0 disables the limit.
+KF_MAX_TAG_SETS = int(os.getenv("KF_MAX_TAG_SETS", default=0))
+# Relative error guaranteed on every quantile read back from a sketch. The
+# default matches the Datadog agent, the ingest must decode with the same value.
+KF_SKETCH_RELATIVE_ACCURACY = float(
+    os.getenv("KF_SKETCH_RELATIVE_ACCURACY", default=1 / 128)
+)
+# Number of source/destination IP pairs and service ports by bytes reported
+# per flush as top_talkers series, 0 disables them. Each ranking is kept in a
+# fixed-size summary of KF_TOP_TALKERS_CAPACITY entries.
+KF_TOP_TALKERS = int(os.getenv("KF_TOP_TALKERS", default=0))
+KF_TOP_TALKERS_CAPACITY = int(os.getenv("KF_TOP_TALKERS_CAPACITY", default=1000))
+# Subnet map (JSON or CSV) of CIDR blocks with their subnet, az, vpc and team.
+# When present, src_*/dst_* tags are added to every flow for the blocks its
+# addresses fall in. The default is subnet_map.json bundled next to this file,
+# and is skipped when missing. KF_SUBNET_CACHE_SIZE addresses are cached.
+KF_SUBNET_MAP = os.getenv(
+    "KF_SUBNET_MAP",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "subnet_map.json"),
+)
+KF_SUBNET_CACHE_SIZE = int(os.getenv("KF_SUBNET_CACHE_SIZE", default=65536))
+# Opt-in aggregation across warm invocations: the aggregates are held in the
+# container and flushed once KF_AGGREGATION_WINDOW seconds have passed since
+# the first invocation held, or in between when they reach the KF_FLUSH_MAX_*
+# size caps below, KF_FLUSH_MAX_POINTS defaulting to 1000000 in this mode.
+# A due flush is put off to the next invocation when less than
+# KF_FLUSH_RESERVE_MS is left, since a timeout resets the container and loses
+# what it holds, as does the container being reclaimed while idle. 0 flushes
+# at the end of every invocation.
+KF_AGGREGATION_WINDOW = float(os.getenv("KF_AGGREGATION_WINDOW", default=0))
+KF_FLUSH_RESERVE_MS = int(os.getenv("KF_FLUSH_RESERVE_MS", default=5000))
+# Once the aggregates of an invocation hold this many datapoints (counter
+# increments, histogram samples and sketches) or series, they are flushed and
+# sent in the background while parsing goes on, and the rest is flushed at the
+# end of the invocation. A series can then get a point per flush for the same
+# timestamp, as it already does across invocations. 0 disables a threshold.
+KF_FLUSH_MAX_POINTS = int(
+    os.getenv("KF_FLUSH_MAX_POINTS", default=1000000 if KF_AGGREGATION_WINDOW else 0)
+)
+KF_FLUSH_MAX_SERIES = int(os.getenv("KF_FLUSH_MAX_SERIES", default=0))
+# lambda_handler checks the time left every KF_DEADLINE_CHECK_RECORDS records.
+# When the next ones may not be done before the KF_FLUSH_RESERVE_MS kept for
+# serializing and sending, it flushes what it has and defers the rest of the
+# batch to KF_SPILL_DIR, where the next warm invocation picks it up first.
+# Deferred payloads count towards KF_SPILL_MAX_BYTES with the spilled chunks.
+KF_DEADLINE_CHECK_RECORDS = int(os.getenv("KF_DEADLINE_CHECK_RECORDS", default=10000))
+# Share of flows kept on every interface, and per-interface overrides as
+# "eni-0a1b:0.1,eni-2c3d:0.01". A flow is kept or dropped by a hash of its
+# 5-tuple, so the same connection is sampled the same way everywhere. Kept
+# flows count 1/rate times and carry a sample_rate tag. 1 disables sampling.
+KF_SAMPLE_RATE = float(os.getenv("KF_SAMPLE_RATE", default=1))
+KF_SAMPLE_RATES = os.getenv("KF_SAMPLE_RATES", default="")
 
 
 def _kfuse_keys():
     if "kmsEncryptedKeys" in os.environ:
+        import boto3
+
         KMS_ENCRYPTED_KEYS = os.environ["kmsEncryptedKeys"]
         kms = boto3.client("kms")
         # kmsEncryptedKeys should be created through the Lambda's encryption
@@ -36,6 +186,8 @@ def _kfuse_keys():
         )
 
     if "KF_API_KEY_SECRET_ARN" in os.environ:
+        import boto3
+
         SECRET_ARN = os.environ["KF_API_KEY_SECRET_ARN"]
         KF_API_KEY = boto3.client("secretsmanager").get_secret_value(
             SecretId=SECRET_ARN
@@ -43,6 +195,8 @@ def _kfuse_keys():
         return {"api_key": KF_API_KEY}
 
     if "KF_API_KEY_SSM_NAME" in os.environ:
+        import boto3
+
         SECRET_NAME = os.environ["KF_API_KEY_SSM_NAME"]
         KF_API_KEY = boto3.client("ssm").get_parameter(
             Name=SECRET_NAME, WithDecryption=True
@@ -50,6 +204,9 @@ def _kfuse_keys():
         return {"api_key": KF_API_KEY}
 
     if "KF_KMS_API_KEY" in os.environ:
+        import boto3
+        import botocore
+
         ENCRYPTED = os.environ["KF_KMS_API_KEY"]
         try:
             KF_API_KEY = boto3.client("kms").decrypt(
@@ -87,359 +244,2245 @@ def _kfuse_keys():
         "Kloudfuse API key is not defined, see documentation for environment variable options"
     )
 
-kfuse_keys = _kfuse_keys()
-logger.info("Lambda function initialized, ready to send metrics")
 
+class Credentials(object):
+    # Kloudfuse keys, resolved on first use instead of at import time and
+    # cached for KF_CREDENTIALS_TTL. prefetch() starts the resolution in the
+    # background so the KMS/Secrets Manager/SSM round trip overlaps with
+    # decoding and parsing the batch.
+    def __init__(self, ttl=KF_CREDENTIALS_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.background = ThreadPoolExecutor(max_workers=1)
+        self.keys = None
+        self.expires = 0
+        self.pending = None
+        self.resolve_seconds = None
 
-def process_message(message, tags, timestamp, node_ip):
-    (
-        version,
-        account_id,
-        interface_id,
-        srcaddr,
-        dstaddr,
-        srcport,
-        dstport,
-        protocol,
-        packets,
-        _bytes,
-        start,
-        end,
-        action,
-        log_status,
-        vpcid,
-    ) = message.split(" ")
-
-    detailed_tags = [
-        "interface_id:%s" % interface_id,
-        "protocol:%s" % protocol_id_to_name(protocol),
-        "ip:%s" % node_ip,
-        "action:%s" % action,
-    ] + tags
-    if srcaddr == node_ip:
-        detailed_tags.append("direction:outbound")
-    if dstaddr == node_ip:
-        detailed_tags.append("direction:inbound")
-
-    process_log_status(log_status, detailed_tags, timestamp)
-    if log_status == "NODATA":
-        return
-
-    process_action(action, detailed_tags, timestamp)
-    process_duration(start, end, detailed_tags, timestamp)
-    process_packets(packets, detailed_tags, timestamp)
-    process_bytes(_bytes, detailed_tags, timestamp)
-
-
-def compute_node_ip(events):
-    ip_count = Counter()
-    for event in events:
-        src_ip, dest_ip = event["message"].split(" ", 5)[3:5]
+    def prefetch(self):
+        with self.lock:
+            if self.pending is None and time.monotonic() >= self.expires:
+                self.pending = self.background.submit(self._resolve)
+            return self.pending
+
+    def get(self):
+        pending = self.prefetch()
+        if pending is not None:
+            return pending.result()
+        return self.keys
+
+    def _resolve(self):
+        start = time.perf_counter()
+        try:
+            keys = _kfuse_keys()
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            self.keys = keys
+            self.expires = time.monotonic() + self.ttl
+            self.pending = None
+            self.resolve_seconds = time.perf_counter() - start
+        return keys
+
+
+credentials = Credentials()
+
+
+# Size of the decompressed slices CloudWatch Logs payloads are decoded in.
+DECODE_CHUNK_SIZE = 256 * 1024
+_LOG_EVENTS_KEY = b'"logEvents"'
+_ARRAY_START = re.compile(rb"\s*:\s*\[")
+# what can be left of _ARRAY_START when a slice ends before the "["
+_ARRAY_START_PREFIX = re.compile(rb"\s*(?::\s*)?")
+_SEPARATORS = re.compile(r"[\s,]*")
+# A '{"' is never inside a JSON string and a string cannot be followed by one
+# of the event keys, so this only matches the start of a log event object.
+_EVENT_BOUNDARY = b'},{"'
+_EVENT_START = re.compile(rb'\{"(?:id|timestamp|message)"')
+
+if msgspec is not None:
+
+    class LogEvent(msgspec.Struct):
+        timestamp: int
+        message: str
+
+    _log_events_decoder = msgspec.json.Decoder(list[LogEvent])
+
+
+def _json_backend():
+    backend = KF_JSON_BACKEND
+    if backend == "auto":
+        if msgspec is not None:
+            return "msgspec"
+        if orjson is not None:
+            return "orjson"
+        return "json"
+    if backend not in ("msgspec", "orjson", "json"):
+        raise ValueError("Unknown JSON backend %r" % backend)
+    if (backend == "msgspec" and msgspec is None) or (
+        backend == "orjson" and orjson is None
+    ):
+        logger.warning(f"{backend} is not installed, decoding JSON with json")
+        return "json"
+    return backend
+
+
+json_backend = _json_backend()
+
+
+def decode_log_events(data, backend=json_backend):
+    # data is a JSON array of log events, returns (message, timestamp) pairs
+    if backend == "msgspec":
+        return [(e.message, e.timestamp) for e in _log_events_decoder.decode(data)]
+    if backend == "orjson":
+        return [(e["message"], e["timestamp"]) for e in orjson.loads(data)]
+    return [(e["message"], e["timestamp"]) for e in json.loads(data)]
+
+
+def decompressed_chunks(compressed, chunk_size=DECODE_CHUNK_SIZE):
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while compressed:
+        chunk = decompressor.decompress(compressed, chunk_size)
+        if chunk:
+            yield chunk
+        compressed = decompressor.unconsumed_tail
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def _last_event_boundary(buf):
+    # index just past the last complete log event in buf, 0 if there is none
+    i = buf.rfind(_EVENT_BOUNDARY)
+    while i >= 0 and not _EVENT_START.match(buf, i + 2):
+        i = buf.rfind(_EVENT_BOUNDARY, 0, i)
+    return i + 1
+
+
+def iter_log_events(compressed, chunk_size=DECODE_CHUNK_SIZE, backend=json_backend):
+    # Lazily yields (message, timestamp) for the logEvents of a gzipped
+    # CloudWatch Logs payload. Only a decompressed slice is held in memory,
+    # instead of the whole decompressed document and its parsed form. With a
+    # fast backend every slice is cut after its last complete event and
+    # decoded in one call, otherwise events are decoded one by one.
+    chunks = decompressed_chunks(compressed, chunk_size)
+
+    buf = b""
+    search = 0
+    while True:
+        start = buf.find(_LOG_EVENTS_KEY, search)
+        if start >= 0:
+            end = start + len(_LOG_EVENTS_KEY)
+            match = _ARRAY_START.match(buf, end)
+            if match:
+                buf = buf[match.end() :]
+                break
+            if not _ARRAY_START_PREFIX.fullmatch(buf, end):
+                # a "logEvents" value, e.g. the log group name: look further
+                search = end
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buf += chunk
+
+    if backend != "json":
+        for chunk in chunks:
+            buf += chunk
+            cut = _last_event_boundary(buf)
+            if cut:
+                yield from decode_log_events(b"[%s]" % buf[:cut], backend)
+                buf = buf[cut + 1 :]
+
+    decode = json.JSONDecoder().raw_decode
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = utf8.decode(buf)
+    pos = 0
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if buf[pos] == "]":
+                return
+            try:
+                log_event, pos = decode(buf, pos)
+            except json.JSONDecodeError:
+                pass  # the event continues in the next slice
+            else:
+                yield log_event["message"], log_event["timestamp"]
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            # truncated payload, raise the decoder's error if anything is left
+            if pos < len(buf):
+                decode(buf, pos)
+            return
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+
+# Fields available in flow log versions 2 to 8, see
+# https://docs.aws.amazon.com/vpc/latest/userguide/flow-log-records.html
+# LogFormat accepts fields outside this list too, only the ones FlowRecord
+# reads need to be known.
+FLOW_LOG_FIELDS = (
+    "version",
+    "account-id",
+    "interface-id",
+    "srcaddr",
+    "dstaddr",
+    "srcport",
+    "dstport",
+    "protocol",
+    "packets",
+    "bytes",
+    "start",
+    "end",
+    "action",
+    "log-status",
+    "vpc-id",
+    "subnet-id",
+    "instance-id",
+    "tcp-flags",
+    "type",
+    "pkt-srcaddr",
+    "pkt-dstaddr",
+    "region",
+    "az-id",
+    "sublocation-type",
+    "sublocation-id",
+    "pkt-src-aws-service",
+    "pkt-dst-aws-service",
+    "flow-direction",
+    "traffic-path",
+    "ecs-cluster-arn",
+    "ecs-cluster-name",
+    "ecs-container-instance-arn",
+    "ecs-container-instance-id",
+    "ecs-container-id",
+    "ecs-second-container-id",
+    "ecs-service-name",
+    "ecs-task-definition-arn",
+    "ecs-task-arn",
+    "ecs-task-id",
+    "reject-reason",
+)
+_LOG_FORMAT_FIELD = re.compile(r"\$\{([a-z0-9-]+)\}")
+
+
+class LogFormat(object):
+    # A flow log LogFormat string compiled into an index-based extractor for
+    # the fields FlowRecord exposes as attributes. Fields missing from the
+    # format read as "-", like fields AWS has no value for, and any other
+    # field is only counted.
+    def __init__(self, format_string):
+        names = _LOG_FORMAT_FIELD.findall(format_string)
+        if not names:
+            raise ValueError("Unsupported flow log format %r" % format_string)
+        self.names = names
+        self.field_count = len(names)
+        self.index = {name: i for i, name in enumerate(names)}
+        # -1 points at the "-" FlowRecord.parse() appends to every record
+        self.extract = itemgetter(
+            *(self.index.get(name, -1) for name in FlowRecord.attribute_fields)
+        )
+
+    @classmethod
+    def from_fields(cls, names):
+        # the header line of S3 text objects, or Parquet column names
+        return cls(" ".join("${%s}" % name.replace("_", "-") for name in names))
+
+
+class FlowRecord(object):
+    # A single flow log record, tokenized once. One instance is reused for
+    # every message of a batch so the hot loop does not allocate per record.
+    attribute_fields = (
+        "interface-id",
+        "srcaddr",
+        "dstaddr",
+        "srcport",
+        "dstport",
+        "protocol",
+        "packets",
+        "bytes",
+        "start",
+        "end",
+        "action",
+        "log-status",
+    )
+    __slots__ = (
+        "log_format",
+        "interface_id",
+        "srcaddr",
+        "dstaddr",
+        "srcport",
+        "dstport",
+        "protocol",
+        "packets",
+        "bytes",
+        "start",
+        "end",
+        "action",
+        "log_status",
+    )
+
+    def __init__(self, log_format):
+        self.log_format = log_format
+
+    def parse(self, fields):
+        fields.append("-")
+        (
+            self.interface_id,
+            self.srcaddr,
+            self.dstaddr,
+            self.srcport,
+            self.dstport,
+            self.protocol,
+            self.packets,
+            self.bytes,
+            self.start,
+            self.end,
+            self.action,
+            self.log_status,
+        ) = self.log_format.extract(fields)
+
+
+log_format = LogFormat(KF_LOG_FORMAT)
+
+# Subnet map columns turned into src_<column> and dst_<column> tags.
+SUBNET_MAP_COLUMNS = ("subnet", "az", "vpc", "team")
+
+
+class SubnetTrie(object):
+    # Path-compressed binary trie over the CIDR blocks of a subnet map, one
+    # per IP version, answering longest-prefix matches. A node is
+    # [prefix, prefix length, value, child 0, child 1]. Lookups by address
+    # string go through an LRU cache, flows mostly repeat their addresses.
+    def __init__(self, cache_size=KF_SUBNET_CACHE_SIZE):
+        self.roots = {4: [0, 0, None, None, None], 6: [0, 0, None, None, None]}
+        self.widths = {4: 32, 6: 128}
+        self.size = 0
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def insert(self, cidr, value):
+        network = ipaddress.ip_network(cidr, strict=False)
+        prefix_length = network.prefixlen
+        prefix = int(network.network_address) >> (network.max_prefixlen - prefix_length)
+        node = self.roots[network.version]
+        self.size += 1
+        while True:
+            if node[1] == prefix_length:
+                node[2] = value
+                return
+            bit = (prefix >> (prefix_length - node[1] - 1)) & 1
+            child = node[3 + bit]
+            if child is None:
+                node[3 + bit] = [prefix, prefix_length, value, None, None]
+                return
+            # length of the prefix shared by the child and the new block
+            shortest = min(child[1], prefix_length)
+            diff = (child[0] >> (child[1] - shortest)) ^ (
+                prefix >> (prefix_length - shortest)
+            )
+            common = shortest - diff.bit_length()
+            if common < child[1]:
+                split = [child[0] >> (child[1] - common), common, None, None, None]
+                split[3 + ((child[0] >> (child[1] - common - 1)) & 1)] = child
+                node[3 + bit] = split
+                child = split
+            node = child
+
+    def _lookup(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        node = self.roots[address.version]
+        width = self.widths[address.version]
+        address = int(address)
+        best = None
+        while node is not None:
+            length = node[1]
+            if address >> (width - length) != node[0]:
+                break
+            if node[2] is not None:
+                best = node[2]
+            if length == width:
+                break
+            node = node[3 + ((address >> (width - length - 1)) & 1)]
+        return best
+
+
+def load_subnet_map(path=KF_SUBNET_MAP):
+    # Reads a JSON list of objects or a CSV file with a header line, both
+    # with a cidr column and any of SUBNET_MAP_COLUMNS. Returns None when
+    # there is no map to load.
+    if not path or (not os.path.exists(path) and "KF_SUBNET_MAP" not in os.environ):
+        return None
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+
+    trie = SubnetTrie()
+    for row in rows:
+        columns = [(c, row[c]) for c in SUBNET_MAP_COLUMNS if row.get(c)]
+        trie.insert(
+            row["cidr"],
+            (
+                tuple("src_%s:%s" % column for column in columns),
+                tuple("dst_%s:%s" % column for column in columns),
+            ),
+        )
+    logger.info(f"INFO Loaded {trie.size} CIDR blocks from {path}")
+    return trie
+
+
+def subnet_tags(subnets, srcaddr, dstaddr):
+    # src_* and dst_* tags of the blocks the addresses of a flow fall in
+    src = subnets.lookup(srcaddr)
+    dst = subnets.lookup(dstaddr)
+    return (src[0] if src else ()) + (dst[1] if dst else ())
+
+
+subnet_map = load_subnet_map()
+
+
+def parse_sample_rates(spec):
+    # "eni-0a1b:0.1,eni-2c3d:0.01" -> {"eni-0a1b": 0.1, "eni-2c3d": 0.01}
+    rates = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        interface_id, _, rate = part.strip().rpartition(":")
+        rates[interface_id] = float(rate)
+    for rate in list(rates.values()) + [KF_SAMPLE_RATE]:
+        if not 0 < rate <= 1:
+            raise ValueError("Sample rates must be in (0, 1], got %r" % rate)
+    return rates
+
+
+sample_rates = parse_sample_rates(KF_SAMPLE_RATES)
+
+
+def sample_hash(record):
+    # Deterministic value in [0, 1) for the 5-tuple of a record, the same in
+    # every process. The endpoints are ordered first so both directions of a
+    # connection are kept or dropped together.
+    src = (record.srcaddr, record.srcport)
+    dst = (record.dstaddr, record.dstport)
+    if dst < src:
+        src, dst = dst, src
+    key = "%s %s %s %s %s" % (src + dst + (record.protocol,))
+    return zlib.crc32(key.encode()) / 4294967296
+
+
+class FlowLogBatch(object):
+    # Parses a batch of flow log messages in a single pass: every message is
+    # split once, and the node IP counts and the per-flow aggregates are
+    # collected together. The node IP is only known once the whole batch has
+    # been seen, so aggregates are keyed by the raw src/dst addresses and the
+    # direction tags are resolved in emit().
+    def __init__(
+        self,
+        rollup_interval=KF_ROLLUP_INTERVAL,
+        log_format=log_format,
+        subnet_map=subnet_map,
+        sample_rate=KF_SAMPLE_RATE,
+        sample_rates=sample_rates,
+    ):
+        self.rollup_interval = rollup_interval
+        self.subnet_map = subnet_map
+        self.sample_rate = sample_rate
+        self.sample_rates = sample_rates
+        self.sampling = sample_rate < 1 or bool(sample_rates)
+        self.sampled_out = 0
+        self.field_count = log_format.field_count
+        self.record = FlowRecord(log_format)
+        self.ip_count = Counter()
+        self.flows = {}
+        self.unsupported_messages = 0
+        # (protocol, service port) -> bytes, for the top talkers. Always
+        # collected: whether they are kept is up to the Stats emitted into,
+        # and the flows do not carry ports to recover them from.
+        self.port_bytes = Counter()
+
+    def process_message(self, message, timestamp=None):
+        self.process_fields(message.split(" "), timestamp)
+
+    def process_fields(self, fields, timestamp=None):
+        # Without a delivery timestamp, as for S3-delivered records, the end of
+        # the capture window is used.
+        if len(fields) != self.field_count:
+            self.unsupported_messages += 1
+            return
+
+        record = self.record
+        record.parse(fields)
+        weight = 1
+        if self.sampling and record.log_status == "OK":
+            rate = self.sample_rates.get(record.interface_id, self.sample_rate)
+            if rate < 1:
+                if sample_hash(record) >= rate:
+                    self.sampled_out += 1
+                    return
+                weight = 1 / rate
+        src_ip, dest_ip = record.srcaddr, record.dstaddr
         if len(src_ip) > 1 and len(dest_ip) > 1:  # account for '-'
-            ip_count[src_ip] += 1
-            ip_count[dest_ip] += 1
-    most_comm = ip_count.most_common()
-    if most_comm:
-        if most_comm[0][1] > 1:  # we have several events
-            return ip_count.most_common()[0][0]
-    return "unknown"
+            self.ip_count[src_ip] += 1
+            self.ip_count[dest_ip] += 1
+        if timestamp is None:
+            timestamp = int(record.end) if record.end != "-" else time.time()
+
+        timestamp = rollup_timestamp(timestamp, self.rollup_interval)
+        key = (
+            timestamp,
+            record.interface_id,
+            record.protocol,
+            record.action,
+            record.log_status,
+            record.srcaddr,
+            record.dstaddr,
+        )
+        flow = self.flows.get(key)
+        if flow is None:
+            # [records, durations, packets, bytes]
+            flow = self.flows[key] = [0, [], [], []]
+        flow[0] += 1
+        if record.log_status == "NODATA":
+            return
+
+        try:
+            flow[1].append(int(record.end) - int(record.start))
+        except ValueError:
+            pass
+        try:
+            flow[2].append(int(record.packets))
+        except ValueError:
+            pass
+        try:
+            flow[3].append(int(record.bytes))
+        except ValueError:
+            return
+        try:
+            # the lower port of the two is taken for the service port
+            port = min(int(record.srcport), int(record.dstport))
+        except ValueError:
+            return
+        self.port_bytes[record.protocol, port] += flow[3][-1] * weight
+
+    def weight(self, interface_id, log_status):
+        # Only flows with data are sampled, each kept one stands for 1/rate.
+        if not self.sampling or log_status != "OK":
+            return 1
+        return 1 / self.sample_rates.get(interface_id, self.sample_rate)
+
+    def node_ip(self):
+        most_comm = self.ip_count.most_common(1)
+        if most_comm:
+            if most_comm[0][1] > 1:  # we have several events
+                return most_comm[0][0]
+        return "unknown"
+
+    def _subnets(self, srcaddr, dstaddr):
+        if self.subnet_map is None:
+            return ()
+        return subnet_tags(self.subnet_map, srcaddr, dstaddr)
+
+    def _admitted_tag_sets(self, stats, tags, node_ip):
+        # The subnet tags are part of a tag set, every combination of them
+        # takes a slot of its own.
+        if not stats.max_tag_sets:
+            return None
+        volumes = defaultdict(int)
+        for key, flow in self.flows.items():
+            _, interface_id, protocol, action, log_status, srcaddr, dstaddr = key
+            direction = (srcaddr == node_ip, dstaddr == node_ip)
+            subnets = self._subnets(srcaddr, dstaddr)
+            volumes[interface_id, protocol, action, direction, subnets] += sum(
+                flow[3]
+            ) * self.weight(interface_id, log_status)
+        admitted = stats.admit_tag_sets(volumes)
+        dropped = len(volumes.keys() - admitted)
+        if dropped:
+            stats.increment("cardinality.dropped_tag_sets", dropped, tags=list(tags))
+        return admitted
+
+    def _add_top_talkers(self, stats, tags):
+        pair_bytes = defaultdict(int)
+        for key, flow in self.flows.items():
+            if flow[3]:
+                pair_bytes[key[5:]] += sum(flow[3]) * self.weight(key[1], key[4])
+        stats.add_top_talkers(
+            tags,
+            pair_bytes,
+            {
+                (protocol_id_to_name(protocol), port): volume
+                for (protocol, port), volume in self.port_bytes.items()
+            },
+        )
+
+    def emit(self, stats, tags):
+        tags = tuple(tags)
+        node_ip = self.node_ip()
+        admitted = self._admitted_tag_sets(stats, tags, node_ip)
+        if stats.top_talkers:
+            self._add_top_talkers(stats, tags)
+        for key, flow in self.flows.items():
+            (
+                timestamp,
+                interface_id,
+                protocol,
+                action,
+                log_status,
+                srcaddr,
+                dstaddr,
+            ) = key
+            records, durations, packets, _bytes = flow
+            direction = (srcaddr == node_ip, dstaddr == node_ip)
+            weight = self.weight(interface_id, log_status)
+            subnets = self._subnets(srcaddr, dstaddr)
+            if (
+                admitted is not None
+                and (interface_id, protocol, action, direction, subnets) not in admitted
+            ):
+                interface_id = protocol = action = OVERFLOW_TAG_VALUE
+                direction = (False, False)
+                subnets = ()
+            status_tags, action_tags, detailed_tags = flow_tag_sets(
+                tags,
+                node_ip,
+                interface_id,
+                protocol,
+                action,
+                direction,
+                log_status,
+                subnets,
+                weight,
+            )
+
+            stats.increment(
+                "log_status", records * weight, tag_set=status_tags, timestamp=timestamp
+            )
+            if log_status == "NODATA":
+                continue
+
+            stats.increment(
+                "action", records * weight, tag_set=action_tags, timestamp=timestamp
+            )
+            if durations:
+                stats.histogram_values(
+                    "duration.per_request",
+                    durations,
+                    tag_set=detailed_tags,
+                    timestamp=timestamp,
+                    weight=weight,
+                )
+            if packets:
+                stats.histogram_values(
+                    "packets.per_request",
+                    packets,
+                    tag_set=detailed_tags,
+                    timestamp=timestamp,
+                    weight=weight,
+                )
+                stats.increment(
+                    "packets.total",
+                    sum(packets) * weight,
+                    tag_set=detailed_tags,
+                    timestamp=timestamp,
+                )
+            if _bytes:
+                stats.histogram_values(
+                    "bytes.per_request",
+                    _bytes,
+                    tag_set=detailed_tags,
+                    timestamp=timestamp,
+                    weight=weight,
+                )
+                stats.increment(
+                    "bytes.total",
+                    sum(_bytes) * weight,
+                    tag_set=detailed_tags,
+                    timestamp=timestamp,
+                )
+
+
+PROTOCOL_NAMES = {
+    0: "HOPOPT",
+    1: "ICMP",
+    2: "IGMP",
+    3: "GGP",
+    4: "IPv4",
+    5: "ST",
+    6: "TCP",
+    7: "CBT",
+    8: "EGP",
+    9: "IGP",
+    10: "BBN-RCC-MON",
+    11: "NVP-II",
+    12: "PUP",
+    13: "ARGUS",
+    14: "EMCON",
+    15: "XNET",
+    16: "CHAOS",
+    17: "UDP",
+    18: "MUX",
+    19: "DCN-MEAS",
+    20: "HMP",
+    21: "PRM",
+    22: "XNS-IDP",
+    23: "TRUNK-1",
+    24: "TRUNK-2",
+    25: "LEAF-1",
+    26: "LEAF-2",
+    27: "RDP",
+    28: "IRTP",
+    29: "ISO-TP4",
+    30: "NETBLT",
+    31: "MFE-NSP",
+    32: "MERIT-INP",
+    33: "DCCP",
+    34: "3PC",
+    35: "IDPR",
+    36: "XTP",
+    37: "DDP",
+    38: "IDPR-CMTP",
+    39: "TP++",
+    40: "IL",
+    41: "IPv6",
+    42: "SDRP",
+    43: "IPv6-Route",
+    44: "IPv6-Frag",
+    45: "IDRP",
+    46: "RSVP",
+    47: "GRE",
+    48: "DSR",
+    49: "BNA",
+    50: "ESP",
+    51: "AH",
+    52: "I-NLSP",
+    53: "SWIPE",
+    54: "NARP",
+    55: "MOBILE",
+    56: "TLSP",
+    57: "SKIP",
+    58: "IPv6-ICMP",
+    59: "IPv6-NoNxt",
+    60: "IPv6-Opts",
+    62: "CFTP",
+    64: "SAT-EXPAK",
+    65: "KRYPTOLAN",
+    66: "RVD",
+    67: "IPPC",
+    69: "SAT-MON",
+    70: "VISA",
+    71: "IPCV",
+    72: "CPNX",
+    73: "CPHB",
+    74: "WSN",
+    75: "PVP",
+    76: "BR-SAT-MON",
+    77: "SUN-ND",
+    78: "WB-MON",
+    79: "WB-EXPAK",
+    80: "ISO-IP",
+    81: "VMTP",
+    82: "SECURE-VMTP",
+    83: "VINES",
+    84: "TTP",
+    84: "IPTM",
+    85: "NSFNET-IGP",
+    86: "DGP",
+    87: "TCF",
+    88: "EIGRP",
+    89: "OSPFIGP",
+    90: "Sprite-RPC",
+    91: "LARP",
+    92: "MTP",
+    93: "AX.25",
+    94: "IPIP",
+    95: "MICP",
+    96: "SCC-SP",
+    97: "ETHERIP",
+    98: "ENCAP",
+    100: "GMTP",
+    101: "IFMP",
+    102: "PNNI",
+    103: "PIM",
+    104: "ARIS",
+    105: "SCPS",
+    106: "QNX",
+    107: "A/N",
+    108: "IPComp",
+    109: "SNP",
+    110: "Compaq-Peer",
+    111: "IPX-in-IP",
+    112: "VRRP",
+    113: "PGM",
+    115: "L2TP",
+    116: "DDX",
+    117: "IATP",
+    118: "STP",
+    119: "SRP",
+    120: "UTI",
+    121: "SMP",
+    122: "SM",
+    123: "PTP",
+    124: "ISIS",
+    125: "FIRE",
+    126: "CRTP",
+    127: "CRUDP",
+    128: "SSCOPMCE",
+    129: "IPLT",
+    130: "SPS",
+    131: "PIPE",
+    132: "SCTP",
+    133: "FC",
+    134: "RSVP-E2E-IGNORE",
+    135: "Mobility",
+    136: "UDPLite",
+    137: "MPLS-in-IP",
+    138: "manet",
+    139: "HIP",
+    140: "Shim6",
+    141: "WESP",
+    142: "ROHC",
+}
+# Keyed by the raw protocol field so the hot path never calls int().
+_PROTOCOL_NAMES_BY_FIELD = {str(k): v for k, v in PROTOCOL_NAMES.items()}
+
+# Direction tags for (srcaddr == node_ip, dstaddr == node_ip).
+_DIRECTION_TAGS = {
+    (False, False): (),
+    (True, False): ("direction:outbound",),
+    (False, True): ("direction:inbound",),
+    (True, True): ("direction:outbound", "direction:inbound"),
+}
+
+# Tag value used for the flows folded together by the KF_MAX_TAG_SETS limit.
+OVERFLOW_TAG_VALUE = "other"
+
+# Interned tag sets, see flow_tag_sets(). Bounded so a warm container that
+# sees many node IPs over its lifetime does not grow without limit.
+_TAG_SET_CACHE_SIZE = 65536
+_tag_sets = {}
 
 
 def protocol_id_to_name(protocol):
-    if protocol == "-":
-        return protocol
-    protocol_map = {
-        0: "HOPOPT",
-        1: "ICMP",
-        2: "IGMP",
-        3: "GGP",
-        4: "IPv4",
-        5: "ST",
-        6: "TCP",
-        7: "CBT",
-        8: "EGP",
-        9: "IGP",
-        10: "BBN-RCC-MON",
-        11: "NVP-II",
-        12: "PUP",
-        13: "ARGUS",
-        14: "EMCON",
-        15: "XNET",
-        16: "CHAOS",
-        17: "UDP",
-        18: "MUX",
-        19: "DCN-MEAS",
-        20: "HMP",
-        21: "PRM",
-        22: "XNS-IDP",
-        23: "TRUNK-1",
-        24: "TRUNK-2",
-        25: "LEAF-1",
-        26: "LEAF-2",
-        27: "RDP",
-        28: "IRTP",
-        29: "ISO-TP4",
-        30: "NETBLT",
-        31: "MFE-NSP",
-        32: "MERIT-INP",
-        33: "DCCP",
-        34: "3PC",
-        35: "IDPR",
-        36: "XTP",
-        37: "DDP",
-        38: "IDPR-CMTP",
-        39: "TP++",
-        40: "IL",
-        41: "IPv6",
-        42: "SDRP",
-        43: "IPv6-Route",
-        44: "IPv6-Frag",
-        45: "IDRP",
-        46: "RSVP",
-        47: "GRE",
-        48: "DSR",
-        49: "BNA",
-        50: "ESP",
-        51: "AH",
-        52: "I-NLSP",
-        53: "SWIPE",
-        54: "NARP",
-        55: "MOBILE",
-        56: "TLSP",
-        57: "SKIP",
-        58: "IPv6-ICMP",
-        59: "IPv6-NoNxt",
-        60: "IPv6-Opts",
-        62: "CFTP",
-        64: "SAT-EXPAK",
-        65: "KRYPTOLAN",
-        66: "RVD",
-        67: "IPPC",
-        69: "SAT-MON",
-        70: "VISA",
-        71: "IPCV",
-        72: "CPNX",
-        73: "CPHB",
-        74: "WSN",
-        75: "PVP",
-        76: "BR-SAT-MON",
-        77: "SUN-ND",
-        78: "WB-MON",
-        79: "WB-EXPAK",
-        80: "ISO-IP",
-        81: "VMTP",
-        82: "SECURE-VMTP",
-        83: "VINES",
-        84: "TTP",
-        84: "IPTM",
-        85: "NSFNET-IGP",
-        86: "DGP",
-        87: "TCF",
-        88: "EIGRP",
-        89: "OSPFIGP",
-        90: "Sprite-RPC",
-        91: "LARP",
-        92: "MTP",
-        93: "AX.25",
-        94: "IPIP",
-        95: "MICP",
-        96: "SCC-SP",
-        97: "ETHERIP",
-        98: "ENCAP",
-        100: "GMTP",
-        101: "IFMP",
-        102: "PNNI",
-        103: "PIM",
-        104: "ARIS",
-        105: "SCPS",
-        106: "QNX",
-        107: "A/N",
-        108: "IPComp",
-        109: "SNP",
-        110: "Compaq-Peer",
-        111: "IPX-in-IP",
-        112: "VRRP",
-        113: "PGM",
-        115: "L2TP",
-        116: "DDX",
-        117: "IATP",
-        118: "STP",
-        119: "SRP",
-        120: "UTI",
-        121: "SMP",
-        122: "SM",
-        123: "PTP",
-        124: "ISIS",
-        125: "FIRE",
-        126: "CRTP",
-        127: "CRUDP",
-        128: "SSCOPMCE",
-        129: "IPLT",
-        130: "SPS",
-        131: "PIPE",
-        132: "SCTP",
-        133: "FC",
-        134: "RSVP-E2E-IGNORE",
-        135: "Mobility",
-        136: "UDPLite",
-        137: "MPLS-in-IP",
-        138: "manet",
-        139: "HIP",
-        140: "Shim6",
-        141: "WESP",
-        142: "ROHC",
-    }
-    return protocol_map.get(int(protocol), protocol)
+    return _PROTOCOL_NAMES_BY_FIELD.get(protocol, protocol)
+
+
+def rollup_timestamp(timestamp, interval):
+    return int(timestamp // interval * interval)
+
 
+def tag_set_key(tags):
+    return ",".join(sorted(tags))
 
-def process_log_status(log_status, tags, timestamp):
-    stats.increment(
-        "log_status", tags=["status:%s" % log_status] + tags, timestamp=timestamp
+
+def flow_tag_sets(
+    tags,
+    node_ip,
+    interface_id,
+    protocol,
+    action,
+    direction,
+    status,
+    subnets=(),
+    weight=1,
+):
+    # Returns the canonical (log_status, action, detailed) tag-set keys for a
+    # flow, computing them only the first time a combination is seen. Sampled
+    # flows (weight > 1) are tagged with their sample rate.
+    key = (
+        tags,
+        node_ip,
+        interface_id,
+        protocol,
+        action,
+        direction,
+        status,
+        subnets,
+        weight,
     )
+    tag_sets = _tag_sets.get(key)
+    if tag_sets is None:
+        if len(_tag_sets) >= _TAG_SET_CACHE_SIZE:
+            _tag_sets.clear()
+        detailed_tags = (
+            [
+                "interface_id:%s" % interface_id,
+                "protocol:%s" % protocol_id_to_name(protocol),
+                "ip:%s" % node_ip,
+                "action:%s" % action,
+            ]
+            + list(tags)
+            + list(_DIRECTION_TAGS[direction])
+            + list(subnets)
+        )
+        if weight != 1:
+            detailed_tags.append("sample_rate:%g" % (1 / weight))
+        tag_sets = _tag_sets[key] = (
+            tag_set_key(["status:%s" % status] + detailed_tags),
+            tag_set_key(["action:%s" % action] + detailed_tags),
+            tag_set_key(detailed_tags),
+        )
+    return tag_sets
+
+
+PERCENTILES = (0, 50, 90, 95, 99, 100)
+
+
+def percentile_metric_suffix(pct):
+    if pct == 0:
+        return "min"
+    if pct == 50:
+        return "median"
+    if pct == 100:
+        return "max"
+    return "p%s" % pct
+
+
+def legacy_rank(pct, total_points):
+    # The index the percentiles mode has always used, kept so its series do
+    # not shift: p99 is the 98th percentile and min is the smallest value.
+    return max(0, int((pct - 1) * total_points / 100))
+
+
+def group_percentiles(
+    group_ids, values, groups, percentiles=PERCENTILES, nearest_rank=True
+):
+    # group_ids and values are parallel typed arrays, every group id in
+    # range(groups) has at least one value. Returns one row of nearest-rank
+    # (or legacy_rank) percentiles per group.
+    if np is not None:
+        ids = np.frombuffer(group_ids, dtype=np.int64)
+        vals = np.frombuffer(values, dtype=np.float64)
+        # sort by value, then stably by group: faster than np.lexsort
+        order = np.argsort(vals)
+        vals = vals[order[np.argsort(ids[order], kind="stable")]]
+        counts = np.bincount(ids, minlength=groups)
+        offsets = np.cumsum(counts) - counts
+        if nearest_rank:
+            ranks = np.ceil(np.outer(counts, percentiles) / 100).astype(np.int64) - 1
+        else:
+            pcts = np.array(percentiles) - 1
+            ranks = np.trunc(np.outer(counts, pcts) / 100).astype(np.int64)
+        np.maximum(ranks, 0, out=ranks)
+        return vals[offsets[:, None] + ranks].tolist()
+
+    grouped = [[] for _ in range(groups)]
+    for group_id, value in zip(group_ids, values):
+        grouped[group_id].append(value)
+    rows = []
+    for vals in grouped:
+        vals.sort()
+        total_points = len(vals)
+        if nearest_rank:
+            ranks = [
+                max(0, math.ceil(pct * total_points / 100) - 1) for pct in percentiles
+            ]
+        else:
+            ranks = [legacy_rank(pct, total_points) for pct in percentiles]
+        rows.append([vals[rank] for rank in ranks])
+    return rows
+
+
+class SketchMapping(object):
+    # Logarithmic value-to-bin mapping of the Datadog agent sketch
+    # (pkg/quantile). Bin keys are signed, 0 holds zero and values too small
+    # to be told apart, and the bin limit bounds memory per sketch.
+    max_key = 32767
+
+    def __init__(self, relative_accuracy, min_value=1e-9, bin_limit=4096):
+        eps = 2 * relative_accuracy
+        self.gamma = 1 + eps
+        self.gamma_ln = math.log1p(eps)
+        self.emin = int(math.floor(math.log(min_value) / self.gamma_ln))
+        self.bias = -self.emin + 1
+        self.min_value = self.gamma**self.emin
+        self.bin_limit = bin_limit
+
+    def key(self, value):
+        if value < 0:
+            return -self.key(-value)
+        if value < self.min_value:
+            return 0
+        key = int(math.floor(math.log(value) / self.gamma_ln + 0.5)) + self.bias
+        return max(1, min(key, self.max_key))
+
+
+class Sketch(object):
+    __slots__ = ("mapping", "bins", "count", "min", "max", "sum")
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.bins = defaultdict(int)
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0
+
+    def extend(self, values, weight=1):
+        # every value is counted weight times
+        key = self.mapping.key
+        bins = self.bins
+        for value in values:
+            bins[key(value)] += weight
+            self.count += weight
+            self.sum += value * weight
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+        if len(bins) > self.mapping.bin_limit:
+            self._collapse()
 
+    def merge(self, other):
+        for key, n in other.bins.items():
+            self.bins[key] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.bins) > self.mapping.bin_limit:
+            self._collapse()
 
-def process_action(action, tags, timestamp):
-    stats.increment("action", tags=["action:%s" % action] + tags, timestamp=timestamp)
+    def _collapse(self):
+        # Fold the lowest bins into the first one that is kept, like the agent
+        # does, so the high quantiles keep their accuracy.
+        keys = sorted(self.bins)
+        excess = len(keys) - self.mapping.bin_limit
+        folded = sum(self.bins.pop(key) for key in keys[:excess])
+        self.bins[keys[excess]] += folded
+
+    def to_dogsketch(self, timestamp):
+        # Sampled values weigh 1/rate, rarely a whole number, and the wire
+        # counts are integers. The count is the sum of the rounded bins so
+        # the two agree. Weights are at least 1, no bin rounds down to 0.
+        keys = sorted(self.bins)
+        counts = [round(self.bins[key]) for key in keys]
+        return Pb.SketchPayload.Sketch.Dogsketch(
+            ts=timestamp,
+            cnt=sum(counts),
+            min=self.min,
+            max=self.max,
+            avg=self.sum / self.count,
+            sum=self.sum,
+            k=keys,
+            n=counts,
+        )
+
+
+class HeavyHitters(object):
+    # Space-Saving summary of the heaviest keys of a weighted stream in fixed
+    # memory. Up to 2 * capacity keys are counted, then only the capacity
+    # heaviest are kept. A key seen after that starts from the heaviest
+    # weight evicted so far, so estimates are never below the true weight
+    # and overshoot it by at most the error kept alongside.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # key -> [estimated weight, error]
+        self.counts = {}
+        self.floor = 0
+
+    def add(self, key, weight):
+        entry = self.counts.get(key)
+        if entry is None:
+            self.counts[key] = [self.floor + weight, self.floor]
+            if len(self.counts) >= 2 * self.capacity:
+                self._prune()
+        else:
+            entry[0] += weight
+
+    def merge(self, other):
+        # a key missing from one summary may have weighed up to its floor
+        for key, entry in self.counts.items():
+            if key not in other.counts:
+                entry[0] += other.floor
+                entry[1] += other.floor
+        for key, (weight, error) in other.counts.items():
+            entry = self.counts.setdefault(key, [self.floor, self.floor])
+            entry[0] += weight
+            entry[1] += error
+        self.floor += other.floor
+        if len(self.counts) >= 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1][0])
+        self.counts = dict(ranked[: self.capacity])
+
+    def top(self, n):
+        # [(key, estimated weight, error)] for the n heaviest keys
+        ranked = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])
+        return [(key, weight, error) for key, (weight, error) in ranked]
+
+
+def payload_chunks(payload, field, max_bytes=KF_MAX_PAYLOAD_BYTES):
+    # Splits the repeated message field of a payload into payloads that
+    # serialize to at most max_bytes. A single oversized item still gets a
+    # chunk of its own.
+    if payload.ByteSize() <= max_bytes:
+        return [payload.SerializeToString()]
+    chunks = []
+    chunk = type(payload)()
+    size = 0
+    for item in getattr(payload, field):
+        # field tag and length prefix take at most 6 bytes
+        item_size = item.ByteSize() + 6
+        if size and size + item_size > max_bytes:
+            chunks.append(chunk.SerializeToString())
+            chunk = type(payload)()
+            size = 0
+        getattr(chunk, field).append(item)
+        size += item_size
+    chunks.append(chunk.SerializeToString())
+    return chunks
+
+
+_pack_double = struct.Struct("<d").pack
+
+
+def _varint(value):
+    # protobuf base 128 varint, negative int64 values take ten bytes
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _length_delimited(tag, data):
+    return tag + _varint(len(data)) + data
+
+
+class SeriesEncoder(object):
+    # Encodes MetricPayload series straight to the protobuf wire format,
+    # byte for byte what MetricPayload.SerializeToString() produces, without
+    # a message object per series and point. The encoded metric names, tag
+    # sets and timestamps are cached since they repeat across series.
+    def __init__(self):
+        self.series = []
+        self.metrics = {}
+        self.tag_sets = {}
+        self.timestamps = {}
 
+    def _metric(self, metric):
+        # MetricSeries.metric, field 2
+        encoded = self.metrics[metric] = _length_delimited(b"\x12", metric.encode())
+        return encoded
 
-def process_duration(start, end, tags, timestamp):
-    stats.histogram(
-        "duration.per_request",
-        int(int(end) - int(start)),
-        tags=tags,
-        timestamp=timestamp,
+    def _tag_set(self, tag_set):
+        # MetricSeries.tags, field 3, from a comma separated tag set
+        encoded = self.tag_sets[tag_set] = b"".join(
+            _length_delimited(b"\x1a", tag.encode())
+            for tag in (tag_set.split(",") if tag_set else ())
+        )
+        return encoded
+
+    def _timestamp(self, timestamp):
+        # MetricSeries.points, field 4, is a MetricPoint with the value as
+        # field 1 and the timestamp as field 2. Returns the point prefix up
+        # to the value, the encoded timestamp and the point without a value,
+        # as zero values are not serialized.
+        encoded_ts = b"\x10" + _varint(timestamp) if timestamp else b""
+        encoded = self.timestamps[timestamp] = (
+            b"\x22" + _varint(9 + len(encoded_ts)) + b"\x09",
+            encoded_ts,
+            _length_delimited(b"\x22", encoded_ts),
+        )
+        return encoded
+
+    def add(self, metric, tag_set, points):
+        # tag_set is a tag_set_key(), points are (timestamp, value) pairs
+        encoded_tags = self.tag_sets.get(tag_set)
+        if encoded_tags is None:
+            encoded_tags = self._tag_set(tag_set)
+        parts = [self.metrics.get(metric) or self._metric(metric), encoded_tags]
+        timestamps = self.timestamps
+        for timestamp, value in points:
+            point = timestamps.get(timestamp) or self._timestamp(timestamp)
+            if value:
+                parts.append(point[0] + _pack_double(value) + point[1])
+            else:
+                parts.append(point[2])
+        # MetricPayload.series, field 1
+        self.series.append(_length_delimited(b"\x0a", b"".join(parts)))
+
+    def chunks(self, max_bytes=KF_MAX_PAYLOAD_BYTES):
+        # Serialized MetricPayloads of at most max_bytes, split between
+        # series like payload_chunks(). No series, no chunk.
+        chunks = []
+        chunk = []
+        size = 0
+        for series in self.series:
+            if size and size + len(series) > max_bytes:
+                chunks.append(b"".join(chunk))
+                chunk = []
+                size = 0
+            chunk.append(series)
+            size += len(series)
+        if chunk:
+            chunks.append(b"".join(chunk))
+        return chunks
+
+
+def compress_payload(data, encoding=KF_COMPRESSION):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def _compression():
+    if KF_COMPRESSION == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing payloads with gzip")
+        return "gzip"
+    if KF_COMPRESSION not in ("none", "gzip", "zstd"):
+        raise ValueError("Unknown compression %r" % KF_COMPRESSION)
+    return KF_COMPRESSION
+
+
+compression = _compression()
+
+
+# Errors of a reused connection the server closed while it was idle. They are
+# raised before any response, so the request is resent on a new connection.
+# Anything else, a timeout in particular, may come after the server accepted
+# the payload, and resending it would count it twice.
+_STALE_CONNECTION_ERRORS = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class ConnectionPool(object):
+    # Keep-alive HTTP(S) connections, kept at module level so they survive
+    # between warm invocations of the Lambda. A reused connection the server
+    # has closed in the meantime is replaced transparently.
+    def __init__(self, timeout=KF_HTTP_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.connections = 0
+        self.connect_seconds = 0.0
+        self.reused = 0
+        # requests resent after a reused connection turned out to be closed
+        self.retries = 0
+
+    def _connection(self, key):
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+        scheme, host, port = key
+        cls = HTTPSConnection if scheme == "https" else HTTPConnection
+        conn = cls(host, port, timeout=self.timeout)
+        start = time.perf_counter()
+        conn.connect()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.connections += 1
+            self.connect_seconds += elapsed
+        return conn, False
+
+    def request(self, url, data, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+
+        while True:
+            conn, reused = self._connection(key)
+            try:
+                conn.request("POST", path, data, headers)
+                response = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                continue
+            except (HTTPException, OSError):
+                conn.close()
+                raise
+            break
+        try:
+            response.read()
+        except (HTTPException, OSError):
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                self.idle[key].append(conn)
+        if reused:
+            with self.lock:
+                self.reused += 1
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.msg, None)
+        return response.status
+
+    def saved_seconds(self):
+        # connect and TLS handshake time avoided by reusing connections,
+        # estimated from the average cost of the connections we did open
+        if not self.connections:
+            return 0.0
+        return self.reused * self.connect_seconds / self.connections
+
+
+connection_pool = ConnectionPool()
+
+
+def uses_proxy(url):
+    # true when urllib would send the request through a proxy: one is set for
+    # the scheme and NO_PROXY does not exempt the host
+    parts = urlsplit(url)
+    return bool(getproxies().get(parts.scheme)) and not proxy_bypass(parts.hostname)
+
+
+def submit_chunk(url, data, encoding=compression):
+    headers = {"Content-Type": "application/x-protobuf"}
+    if encoding != "none":
+        headers["Content-Encoding"] = encoding
+        data = compress_payload(data, encoding)
+    if uses_proxy(url):
+        # http.client does not route through proxies, leave that to urllib
+        response = urlopen(Request(url, data, headers), timeout=KF_HTTP_TIMEOUT)
+        return response.getcode()
+    return connection_pool.request(url, data, headers)
+
+
+def submit_chunks(chunks, concurrency=KF_SEND_CONCURRENCY):
+    # chunks is a list of (url, serialized payload). Every chunk is attempted
+    # and its outcome logged, the failed ones are returned as
+    # (url, serialized payload, error).
+    if len(chunks) == 1 or concurrency <= 1:
+        results = []
+        for url, data in chunks:
+            try:
+                results.append(submit_chunk(url, data))
+            except Exception as e:
+                results.append(e)
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as pool:
+            futures = [pool.submit(submit_chunk, url, data) for url, data in chunks]
+        results = [f.exception() or f.result() for f in futures]
+
+    failed = [
+        (url, data, result)
+        for (url, data), result in zip(chunks, results)
+        if isinstance(result, Exception)
+    ]
+    for i, ((url, data), result) in enumerate(zip(chunks, results)):
+        logger.info(
+            f"INFO Chunk {i + 1}/{len(chunks)} ({len(data)} bytes) to {url}: {result}"
+        )
+    logger.info(
+        f"INFO Reused {connection_pool.reused} of "
+        f"{connection_pool.reused + connection_pool.connections} connections, "
+        f"avoided {connection_pool.saved_seconds() * 1000:.1f}ms of connect time"
     )
+    return failed
+
+
+def retryable(error):
+    # client errors other than throttling will fail the same way next time
+    return not isinstance(error, HTTPError) or error.code >= 500 or error.code == 429
+
+
+class SpillQueue(object):
+    # Bounded on-disk queue of chunks that could not be submitted. Each chunk
+    # is one file named <created ns>-<attempts>-<next attempt epoch>.chunk
+    # holding the URL on the first line followed by the serialized payload,
+    # so the queue survives between warm invocations of the same container.
+    # CloudWatch Logs payloads lambda_handler ran out of time for are kept
+    # alongside as <created ns>-<events processed>.payload files, holding the
+    # compressed payload as received, and share the max_bytes limit. The
+    # payloads handed out by deferred() are not evicted until they are
+    # removed or deferred again: chunks spilled by the background sender
+    # evict from the same directory while lambda_handler processes them.
+    def __init__(
+        self,
+        directory=KF_SPILL_DIR,
+        max_bytes=KF_SPILL_MAX_BYTES,
+        backoff=KF_SPILL_BACKOFF,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backoff = backoff
+        # chunks given up on, non-retryable or evicted
+        self.dropped = 0
+        # deferred payloads evicted, failed, or dropped without a directory
+        self.dropped_payloads = 0
+        self.lock = threading.Lock()
+        self.claimed = set()
 
+    def _files(self, suffixes=(".chunk",)):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.endswith(suffixes))
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def spill(self, failed):
+        if not self.directory:
+            raise failed[0][2]
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        for url, data, error in failed:
+            if not retryable(error):
+                logger.error(f"ERROR Dropping {len(data)} bytes for {url}: {error}")
+                self.dropped += 1
+                continue
+            name = "%020d-%d-%d.chunk" % (time.time_ns(), 0, now + self.backoff)
+            self._write(name, url.encode() + b"\n" + data)
+        self._evict()
+
+    def _evict(self):
+        # drop the oldest chunks and payloads once the queue is over its size
+        # limit, both are named after their creation time
+        with self.lock:
+            files = self._files((".chunk", ".payload"))
+            sizes = [os.path.getsize(os.path.join(self.directory, n)) for n in files]
+            total = sum(sizes)
+            for name, size in zip(files, sizes):
+                if total <= self.max_bytes:
+                    break
+                if name in self.claimed:
+                    continue
+                logger.warning(f"WARNING Spill queue full, dropping {name}")
+                os.remove(os.path.join(self.directory, name))
+                if name.endswith(".chunk"):
+                    self.dropped += 1
+                else:
+                    self.dropped_payloads += 1
+                total -= size
+
+    def defer(self, data, processed, name=None):
+        # Keeps a payload with the number of its events already processed.
+        # name is that of a payload deferred before, which is kept with its
+        # creation time and the new count.
+        if not self.directory:
+            logger.error("ERROR Out of time, dropping a payload")
+            self.dropped_payloads += 1
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if name is None:
+            created = time.time_ns()
+            self._write("%020d-%d.payload" % (created, processed), data)
+        else:
+            created = int(name.split("-", 1)[0])
+            with self.lock:
+                os.replace(
+                    os.path.join(self.directory, name),
+                    os.path.join(
+                        self.directory, "%020d-%d.payload" % (created, processed)
+                    ),
+                )
+                self.claimed.discard(name)
+        self._evict()
+
+    def deferred(self):
+        # (name, compressed payload, events processed) of the deferred
+        # payloads, oldest first. They stay until removed with
+        # remove_deferred() or deferred again.
+        payloads = []
+        with self.lock:
+            for name in self._files((".payload",)):
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    data = f.read()
+                processed = int(name[: -len(".payload")].split("-")[1])
+                payloads.append((name, data, processed))
+            self.claimed = set(name for name, _, _ in payloads)
+        return payloads
+
+    def remove_deferred(self, name, dropped=False):
+        # dropped is for a payload given up on rather than processed
+        with self.lock:
+            os.remove(os.path.join(self.directory, name))
+            self.claimed.discard(name)
+            if dropped:
+                self.dropped_payloads += 1
+
+    def replay(self, seconds=None, concurrency=KF_SEND_CONCURRENCY):
+        # Returns the number of chunks resubmitted. They are sent concurrency
+        # at a time, and with seconds no more are started once the next ones,
+        # taking as long as the last, may not be done within that time.
+        now = time.time()
+        due = []
+        for name in self._files():
+            created, attempts, next_attempt = name[: -len(".chunk")].split("-")
+            if float(next_attempt) > now:
+                continue
+            with open(os.path.join(self.directory, name), "rb") as f:
+                url, data = f.read().split(b"\n", 1)
+            due.append((name, created, int(attempts), url.decode(), data))
+        if not due:
+            return 0
+
+        logger.info(f"INFO Replaying {len(due)} spilled chunks")
+        started = time.perf_counter()
+        group = max(concurrency, 1)
+        for i in range(0, len(due), group):
+            if seconds is not None:
+                elapsed = time.perf_counter() - started
+                if elapsed + (elapsed / (i // group) if i else 0) >= seconds:
+                    logger.info(
+                        f"INFO Out of time, leaving {len(due) - i} spilled chunks"
+                    )
+                    return i
+            self._replay(due[i : i + group], now)
+        return len(due)
+
+    def _replay(self, due, now):
+        failed = submit_chunks([(url, data) for _, _, _, url, data in due])
+        failed = {id(data): error for _, data, error in failed}
+        for name, created, attempts, url, data in due:
+            os.remove(os.path.join(self.directory, name))
+            error = failed.get(id(data))
+            if error is None or not retryable(error):
+                continue
+            attempts += 1
+            next_attempt = now + min(self.backoff * 2**attempts, 300)
+            name = "%s-%d-%d.chunk" % (created, attempts, next_attempt)
+            self._write(name, url.encode() + b"\n" + data)
+
+
+spill_queue = SpillQueue()
+
+
+def send_chunks(chunks):
+    failed = submit_chunks(chunks)
+    if failed:
+        spill_queue.spill(failed)
+
+
+class BackgroundSender(object):
+    # Sends flushed chunks from a single background thread so parsing can go
+    # on meanwhile. At most one send is in flight: submitting the next one
+    # waits for it, which bounds the payloads held in memory to two.
+    def __init__(self):
+        self.background = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def submit(self, chunks):
+        self.drain()
+        self.pending = self.background.submit(send_chunks, chunks)
 
-def process_packets(packets, tags, timestamp):
-    try:
-        stats.histogram(
-            "packets.per_request", int(packets), tags=tags, timestamp=timestamp
+    def drain(self):
+        # waits for the send in flight, re-raising its error if it failed
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.result()
+
+
+background_sender = BackgroundSender()
+
+
+# Datapoints are addressed by a cell, series id << _CELL_SHIFT | timestamp,
+# stored as an int64. That leaves room for epoch second timestamps well past
+# the year 10000 and 2**23 series per flush.
+_CELL_SHIFT = 40
+_CELL_TIMESTAMP_MASK = (1 << _CELL_SHIFT) - 1
+# Counter increments are folded into one value per cell once this many have
+# been appended since the last fold, or twice as many as the fold kept.
+_COMPACT_MIN = 65536
+
+
+def sum_by_key(keys, values):
+    # Sums the values of parallel int64/double arrays per key, returns the
+    # distinct keys and their sums as arrays.
+    if np is not None:
+        unique, inverse = np.unique(
+            np.frombuffer(keys, dtype=np.int64), return_inverse=True
         )
-        stats.increment("packets.total", int(packets), tags=tags, timestamp=timestamp)
-    except ValueError:
-        pass
+        sums = np.bincount(inverse, weights=np.frombuffer(values, dtype=np.float64))
+        return array("q", unique.tobytes()), array("d", sums.tobytes())
+    totals = defaultdict(float)
+    for key, value in zip(keys, values):
+        totals[key] += value
+    return array("q", totals.keys()), array("d", totals.values())
 
 
-def process_bytes(_bytes, tags, timestamp):
-    try:
-        stats.histogram(
-            "bytes.per_request", int(_bytes), tags=tags, timestamp=timestamp
+def dense_ids(keys):
+    # Maps an int64 array of keys to ids in range(distinct keys), returns
+    # the distinct keys and the id of every key.
+    if np is not None:
+        unique, inverse = np.unique(
+            np.frombuffer(keys, dtype=np.int64), return_inverse=True
         )
-        stats.increment("bytes.total", int(_bytes), tags=tags, timestamp=timestamp)
-    except ValueError:
-        pass
+        return unique.tolist(), array("q", inverse.astype(np.int64).tobytes())
+    ids = {}
+    group_ids = array("q", (ids.setdefault(key, len(ids)) for key in keys))
+    return list(ids), group_ids
+
+
+def series_points(cells, values):
+    # Groups parallel cells and values into {series id: (timestamp, value)
+    # pairs}, iterable once. With numpy the cells must be sorted, as
+    # sum_by_key() and dense_ids() return them, and are split into series on
+    # the whole array.
+    if isinstance(values, array):
+        values = values.tolist()
+    if np is None:
+        series = defaultdict(list)
+        for cell, value in zip(cells, values):
+            series[cell >> _CELL_SHIFT].append((cell & _CELL_TIMESTAMP_MASK, value))
+        return series
+
+    cells = np.asarray(cells, dtype=np.int64)
+    series_ids = cells >> _CELL_SHIFT
+    timestamps = (cells & _CELL_TIMESTAMP_MASK).tolist()
+    starts = np.flatnonzero(np.diff(series_ids, prepend=-1)).tolist()
+    ends = starts[1:] + [len(timestamps)]
+    return {
+        series_id: zip(timestamps[start:end], values[start:end])
+        for series_id, start, end in zip(series_ids[starts].tolist(), starts, ends)
+    }
 
 
 class Stats(object):
     def _initialize(self):
-        self.counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-        self.histograms = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        # Series are interned to small integer ids: series_ids maps
+        # (metric, tag_set) to an id and series_keys[id] holds it back.
+        self.series_ids = {}
+        self.series_keys = []
+        # counters: the cell and value of every increment in parallel
+        # arrays, summed per cell by _compact_counters()
+        self.counter_cells = array("q")
+        self.counter_values = array("d")
+        self.compact_at = _COMPACT_MIN
+        # histograms in sketch mode: cell -> Sketch. Otherwise every value
+        # with its cell, in parallel arrays.
+        self.sketch_cells = {}
+        self.histogram_cells = array("q")
+        self.histogram_samples = array("d")
+        # flow tag sets granted by admit_tag_sets() since the last flush
+        self.admitted_tag_sets = set()
+        self.dropped_tag_sets = 0
+        # (tag set, srcaddr, dstaddr) and (tag set, protocol, port) by bytes
+        self.top_pairs = HeavyHitters(self.top_talkers_capacity)
+        self.top_ports = HeavyHitters(self.top_talkers_capacity)
+        # epoch seconds of the first invocation held since the last flush
+        self.window_started = None
 
-    def __init__(self):
+    def __init__(
+        self,
+        histogram_mode=KF_HISTOGRAM_MODE,
+        relative_accuracy=KF_SKETCH_RELATIVE_ACCURACY,
+        rollup_interval=KF_ROLLUP_INTERVAL,
+        max_tag_sets=KF_MAX_TAG_SETS,
+        top_talkers=KF_TOP_TALKERS,
+        top_talkers_capacity=KF_TOP_TALKERS_CAPACITY,
+        flush_max_points=KF_FLUSH_MAX_POINTS,
+        flush_max_series=KF_FLUSH_MAX_SERIES,
+    ):
+        if histogram_mode not in ("percentiles", "exact", "sketch"):
+            raise ValueError("Unknown histogram mode %r" % histogram_mode)
+        self.sketches = histogram_mode == "sketch"
+        self.exact = histogram_mode == "exact"
+        self.rollup_interval = rollup_interval
+        self.max_tag_sets = max_tag_sets
+        self.top_talkers = top_talkers
+        self.top_talkers_capacity = max(top_talkers, top_talkers_capacity)
+        self.flush_max_points = flush_max_points
+        self.flush_max_series = flush_max_series
+        self.sketch_mapping = SketchMapping(relative_accuracy)
         self._initialize()
         self.metric_prefix = "aws.vpc.flowlogs"
+        self.metric_names = {}
+
+    def new_sketch(self):
+        return Sketch(self.sketch_mapping)
+
+    def _metric_name(self, metric):
+        metric_name = self.metric_names.get(metric)
+        if metric_name is None:
+            metric_name = self.metric_names[metric] = "%s.%s" % (
+                self.metric_prefix,
+                metric,
+            )
+        return metric_name
+
+    def admit_tag_sets(self, volumes):
+        # volumes maps the tag sets seen in a batch to their traffic volume.
+        # Tag sets admitted earlier in this flush period keep their slot, new
+        # ones compete by volume for what is left of the budget.
+        admitted = self.admitted_tag_sets
+        candidates = [tag_set for tag_set in volumes if tag_set not in admitted]
+        room = max(0, self.max_tag_sets - len(admitted))
+        if len(candidates) > room:
+            self.dropped_tag_sets += len(candidates) - room
+            candidates = heapq.nlargest(room, candidates, key=volumes.__getitem__)
+        admitted.update(candidates)
+        return admitted
+
+    def add_top_talkers(self, tags, pair_bytes, port_bytes):
+        tag_set = tag_set_key(tags)
+        for (srcaddr, dstaddr), volume in pair_bytes.items():
+            self.top_pairs.add((tag_set, srcaddr, dstaddr), volume)
+        for (protocol, port), volume in port_bytes.items():
+            self.top_ports.add((tag_set, protocol, port), volume)
+
+    def over_flush_threshold(self):
+        # Counter increments are counted as stored, before they are folded.
+        points = (
+            len(self.counter_cells) + len(self.histogram_cells) + len(self.sketch_cells)
+        )
+        if self.flush_max_points and points >= self.flush_max_points:
+            return True
+        return bool(
+            self.flush_max_series and len(self.series_keys) >= self.flush_max_series
+        )
+
+    def _series_id(self, metric, tag_set):
+        key = (metric, tag_set)
+        series_id = self.series_ids.get(key)
+        if series_id is None:
+            series_id = self.series_ids[key] = len(self.series_keys)
+            self.series_keys.append(key)
+        return series_id
 
-    def increment(self, metric, value=1, timestamp=None, tags=None):
-        metric_name = "%s.%s" % (self.metric_prefix, metric)
-        timestamp = timestamp or int(time.time())
-        _tags = ",".join(sorted(tags))
-        self.counts[metric_name][_tags][timestamp] += value
-
-    def histogram(self, metric, value=1, timestamp=None, tags=None):
-        metric_name = "%s.%s" % (self.metric_prefix, metric)
-        timestamp = timestamp or int(time.time())
-        _tags = ",".join(sorted(tags))
-        self.histograms[metric_name][_tags][timestamp].append(value)
-
-    def flush(self):
-        percentiles_to_submit = [0, 50, 90, 95, 99, 100]
-        payload = Pb.MetricPayload()
-
-        for metric_name, count_payload in self.counts.items():
-            for tag_set, datapoints in count_payload.items():
-                points = [(ts, val) for ts, val in datapoints.items()]
-                s = Pb.MetricPayload.MetricSeries()
-                s.metric = metric_name
-                s.tags.extend(tag_set.split(","))
-                for point in points:
-                    p = Pb.MetricPayload.MetricPoint()
-                    p.timestamp = int(point[0])
-                    p.value = point[1]
-                    s.points.append(p)
-                payload.series.append(s)
-
-        for metric_name, histogram_payload in self.histograms.items():
-            for tag_set, datapoints in histogram_payload.items():
-                percentiles = defaultdict(list)
-                for ts, values in datapoints.items():
-                    values.sort()
-                    total_points = len(values)
-                    for pct in percentiles_to_submit:
-                        percentiles[pct].append(
-                            (ts, values[max(0, int((pct - 1) * total_points / 100))])
-                        )
-
-                for pct, points in percentiles.items():
-                    metric_suffix = "p%s" % pct
-                    if pct == 0:
-                        metric_suffix = "min"
-                    if pct == 50:
-                        metric_suffix = "median"
-                    if pct == 100:
-                        metric_suffix = "max"
-                    s = Pb.MetricPayload.MetricSeries()
-                    s.metric = "%s.%s" % (metric_name, metric_suffix)
-                    s.tags.extend(tag_set.split(","))
-                    for point in points:
-                        p = Pb.MetricPayload.MetricPoint()
-                        p.timestamp = int(point[0])
-                        p.value = point[1]
-                        s.points.append(p)
-                    payload.series.append(s)
+    # tag_set takes a key from tag_set_key()/flow_tag_sets() and skips
+    # building and sorting the tag list on every call.
+    def increment(self, metric, value=1, timestamp=None, tags=None, tag_set=None):
+        timestamp = rollup_timestamp(timestamp or time.time(), self.rollup_interval)
+        if tag_set is None:
+            tag_set = tag_set_key(tags)
+        self.counter_cells.append(
+            self._series_id(metric, tag_set) << _CELL_SHIFT | timestamp
+        )
+        self.counter_values.append(value)
+        if len(self.counter_cells) >= self.compact_at:
+            self._compact_counters()
+
+    def _compact_counters(self):
+        self.counter_cells, self.counter_values = sum_by_key(
+            self.counter_cells, self.counter_values
+        )
+        self.compact_at = max(_COMPACT_MIN, 2 * len(self.counter_cells))
+
+    def histogram(self, metric, value=1, timestamp=None, tags=None, tag_set=None):
+        self.histogram_values(metric, (value,), timestamp, tags, tag_set)
+
+    # weight is the number of values each one stands for, as for sampled
+    # flows. Only sketches need it: the percentile series of a cell are the
+    # same for any weight shared by all its values, and sampled flows carry
+    # their rate in their tags.
+    def histogram_values(
+        self, metric, values, timestamp=None, tags=None, tag_set=None, weight=1
+    ):
+        if not values:
+            return
+        timestamp = rollup_timestamp(timestamp or time.time(), self.rollup_interval)
+        if tag_set is None:
+            tag_set = tag_set_key(tags)
+        cell = self._series_id(metric, tag_set) << _CELL_SHIFT | timestamp
+        if self.sketches:
+            sketch = self.sketch_cells.get(cell)
+            if sketch is None:
+                sketch = self.sketch_cells[cell] = self.new_sketch()
+            sketch.extend(values, weight)
+            return
+        self.histogram_cells.extend([cell] * len(values))
+        self.histogram_samples.extend(values)
+
+    def merge(self, other):
+        # Adds the aggregates of another Stats configured the same way, e.g.
+        # one filled in by a worker process. Its series ids are mapped to
+        # ours first.
+        series_ids = [self._series_id(*key) for key in other.series_keys]
+
+        def own(cell):
+            return (
+                series_ids[cell >> _CELL_SHIFT] << _CELL_SHIFT
+                | cell & _CELL_TIMESTAMP_MASK
+            )
+
+        self.counter_cells.extend(map(own, other.counter_cells))
+        self.counter_values.extend(other.counter_values)
+        self._compact_counters()
+
+        for cell, sketch in other.sketch_cells.items():
+            cell = own(cell)
+            if cell in self.sketch_cells:
+                self.sketch_cells[cell].merge(sketch)
+            else:
+                self.sketch_cells[cell] = sketch
+
+        self.histogram_cells.extend(map(own, other.histogram_cells))
+        self.histogram_samples.extend(other.histogram_samples)
 
+        self.admitted_tag_sets |= other.admitted_tag_sets
+        self.dropped_tag_sets += other.dropped_tag_sets
+        self.top_pairs.merge(other.top_pairs)
+        self.top_ports.merge(other.top_ports)
+
+    # With background=True the chunks are handed to background_sender and
+    # flush returns before they are sent. Every flush first waits for the
+    # previous background send, so a final flush drains them all.
+    # replay_seconds bounds the time spent resubmitting spilled chunks.
+    def flush(self, tags=(), background=False, replay_seconds=None):
+        flush_started = time.perf_counter()
+        # Waits for the previous send and resolves the keys before anything
+        # is cleared, so if either fails the aggregates are kept for the next
+        # flush instead of being lost.
+        background_sender.drain()
+        kfuse_keys = credentials.get()
+        payload = SeriesEncoder()
+        self._compact_counters()
+        counters = series_points(self.counter_cells, self.counter_values)
+        for series_id, points in counters.items():
+            metric, tag_set = self.series_keys[series_id]
+            payload.add(self._metric_name(metric), tag_set, points)
+
+        sketch_payload = Pb.SketchPayload()
+        cells = sorted(self.sketch_cells)
+        sketches = series_points(cells, [self.sketch_cells[cell] for cell in cells])
+        for series_id, points in sketches.items():
+            metric, tag_set = self.series_keys[series_id]
+            sketch = sketch_payload.sketches.add()
+            sketch.metric = self._metric_name(metric)
+            sketch.tags.extend(tag_set.split(","))
+            sketch.dogsketches.extend(h.to_dogsketch(ts) for ts, h in points)
+
+        if self.histogram_cells:
+            self._percentile_series(payload)
+        if self.top_talkers:
+            self._top_talker_series(payload)
+
+        dropped_tag_sets = self.dropped_tag_sets
+        if dropped_tag_sets:
+            logger.info(
+                f"INFO Folded {dropped_tag_sets} tag sets over the limit of "
+                f"{self.max_tag_sets} into {OVERFLOW_TAG_VALUE}"
+            )
         self._initialize()
 
-        creds = urlencode(kfuse_keys)
-        data = payload.SerializeToString()
+        if replay_seconds is not None:
+            replay_seconds -= time.perf_counter() - flush_started
+        replayed = spill_queue.replay(replay_seconds)
         url = "%s" % (
             kfuse_keys.get("api_host", "%s/api/v2/series" % KFUSE_ENDPOINT)
         )
-        req = Request(url, data, {"Content-Type": "application/x-protobuf"})
-        response = urlopen(req)
-        logger.info(f"INFO Submitted data with status {response.getcode()}")
+        series_url = url
+        chunks = [(url, data) for data in payload.chunks()]
+        series_chunks = len(chunks)
+        if sketch_payload.sketches:
+            url = kfuse_keys.get("sketch_host", "%s/api/beta/sketches" % KFUSE_ENDPOINT)
+            chunks.extend(
+                (url, data) for data in payload_chunks(sketch_payload, "sketches")
+            )
 
+        # The forwarder's own series describe the payload above. Retries and
+        # dropped chunks are the ones seen since the previous flush.
+        forwarder = self._forwarder_payload(
+            tags,
+            series=len(payload.series) + len(sketch_payload.sketches),
+            payload_bytes=sum(len(data) for _, data in chunks),
+            flush_seconds=time.perf_counter() - flush_started,
+            retries=replayed + connection_pool.retries,
+            dropped_chunks=spill_queue.dropped,
+            dropped_payloads=spill_queue.dropped_payloads,
+            dropped_tag_sets=dropped_tag_sets,
+        )
+        connection_pool.retries = spill_queue.dropped = 0
+        spill_queue.dropped_payloads = 0
+        # They ride along in the last series chunk rather than a request of
+        # their own: concatenated MetricPayloads decode as one payload with
+        # the series of both. That chunk may go over max_bytes by their size.
+        forwarder_data = forwarder.chunks()[0]
+        if series_chunks:
+            data = chunks[series_chunks - 1][1] + forwarder_data
+            chunks[series_chunks - 1] = (series_url, data)
+        else:
+            chunks.insert(0, (series_url, forwarder_data))
+        if background:
+            background_sender.submit(chunks)
+        else:
+            send_chunks(chunks)
 
-stats = Stats()
+    def _top_talker_series(self, payload):
+        # top_talkers.pair.bytes and top_talkers.port.bytes, at most
+        # top_talkers series each, stamped with the flush time
+        timestamp = rollup_timestamp(time.time(), self.rollup_interval)
+        for metric, summary, names in (
+            ("top_talkers.pair.bytes", self.top_pairs, ("src_ip", "dst_ip")),
+            ("top_talkers.port.bytes", self.top_ports, ("protocol", "port")),
+        ):
+            metric_name = self._metric_name(metric)
+            for key, volume, _ in summary.top(self.top_talkers):
+                tags = ["%s:%s" % tag for tag in zip(names, key[1:])]
+                if key[0]:
+                    tags += key[0].split(",")
+                tag_set = tag_set_key(tags)
+                payload.add(metric_name, tag_set, [(timestamp, volume)])
 
+    def _forwarder_payload(self, tags, **values):
+        timestamp = rollup_timestamp(time.time(), self.rollup_interval)
+        payload = SeriesEncoder()
+        tag_set = tag_set_key(tags)
+        for name, value in values.items():
+            metric_name = self._metric_name("forwarder.%s" % name)
+            payload.add(metric_name, tag_set, [(timestamp, value)])
+        return payload
 
-def lambda_handler(event, context):
-    # event is a dict containing a base64 string gzipped
-    with gzip.GzipFile(
-        fileobj=BytesIO(base64.b64decode(event["awslogs"]["data"]))
-    ) as decompress_stream:
-        data = b"".join(BufferedReader(decompress_stream))
+    def _percentile_series(self, payload):
+        # min/median/p90/p95/p99/max series of every histogram, computed in
+        # one pass over the arrays. The percentiles mode keeps the ranks it
+        # has always submitted, exact uses nearest rank.
+        cells, group_ids = dense_ids(self.histogram_cells)
+        rows = group_percentiles(
+            group_ids, self.histogram_samples, len(cells), nearest_rank=self.exact
+        )
+        series = series_points(cells, rows)
+        for series_id, points in series.items():
+            points = list(points)
+            metric, tag_set = self.series_keys[series_id]
+            metric_name = self._metric_name(metric)
+            for i, pct in enumerate(PERCENTILES):
+                payload.add(
+                    "%s.%s" % (metric_name, percentile_metric_suffix(pct)),
+                    tag_set,
+                    [(ts, row[i]) for ts, row in points],
+                )
 
-    event = json.loads(data)
+
+stats = Stats()
+init_seconds = time.perf_counter() - init_started
+cold_start = True
+logger.info("Lambda function initialized, ready to send metrics")
+
+
+def invocation_tags(context):
     function_arn = context.invoked_function_arn
     # 'arn:aws:lambda:us-east-1:1234123412:function:VPCFlowLogs'
     region, account = function_arn.split(":", 5)[3:5]
+    return ["region:%s" % region, "aws_account:%s" % account]
+
+
+def emit_batch(batch, tags):
+    batch.emit(stats, tags)
+    records = sum(flow[0] for flow in batch.flows.values()) + batch.sampled_out
+    stats.increment("forwarder.records_parsed", value=records, tags=tags)
+    if batch.sampled_out:
+        stats.increment(
+            "forwarder.records_sampled_out", value=batch.sampled_out, tags=tags
+        )
+    if batch.unsupported_messages:
+        logger.info("Unsupported vpc flowlog message type, please contact Kloudfuse")
+        stats.increment(
+            "unsupported_message", value=batch.unsupported_messages, tags=tags
+        )
+        stats.increment(
+            "forwarder.records_unsupported",
+            value=batch.unsupported_messages,
+            tags=tags,
+        )
+    if stats.over_flush_threshold():
+        stats.flush(tags, background=True)
+
+
+def timed(iterable, seconds):
+    # Yields from iterable, adding the time spent producing the items to
+    # seconds[0], so a streaming stage can be timed apart from its consumer.
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        item = next(iterator, timed)
+        seconds[0] += time.perf_counter() - start
+        if item is timed:
+            return
+        yield item
+
+
+def flush_or_hold(tags, context, window=KF_AGGREGATION_WINDOW):
+    # Ends an invocation: flushes stats, or with an aggregation window holds
+    # them for the next warm invocation until the window is over. Background
+    # sends are always waited for, the container is frozen once we return.
+    now = time.time()
+    if stats.window_started is None:
+        stats.window_started = now
+    if now - stats.window_started >= window:
+        remaining_ms = context.get_remaining_time_in_millis()
+        if window <= 0 or remaining_ms >= KF_FLUSH_RESERVE_MS:
+            # the reserve is kept for sending this flush, replaying spilled
+            # chunks only gets the time beyond it
+            stats.flush(
+                tags, replay_seconds=(remaining_ms - KF_FLUSH_RESERVE_MS) / 1000
+            )
+            return
+        logger.info(
+            f"INFO Holding the aggregation window, {remaining_ms}ms left is under "
+            f"the {KF_FLUSH_RESERVE_MS}ms flush reserve"
+        )
+    background_sender.drain()
+
+
+def record_invocation(tags, **seconds):
+    # forwarder.<stage>_seconds counters and the invocation count by start type
+    start = "start:cold" if cold_start else "start:warm"
+    stats.increment("forwarder.invocations", tags=tags + [start])
+    for stage, value in seconds.items():
+        stats.increment("forwarder.%s_seconds" % stage, value=value, tags=tags)
+
 
-    tags = ["region:%s" % region, "aws_account:%s" % account]
-    unsupported_messages = 0
+def _log_cold_start(invocation_started):
+    global cold_start
+    if cold_start:
+        cold_start = False
+        logger.info(
+            f"INFO Cold start: init {init_seconds * 1000:.1f}ms, "
+            f"credentials {(credentials.resolve_seconds or 0) * 1000:.1f}ms "
+            f"(resolved alongside parsing), first invocation "
+            f"{(time.perf_counter() - invocation_started) * 1000:.1f}ms"
+        )
+
+
+class Deadline(object):
+    # Checks the time left every check_records records, counted across all
+    # the payloads of an invocation. out_of_time() is called once per record
+    # and is True when the next check_records records, taking as long as the
+    # last ones, may not be done before the time reserved for the flush.
+    def __init__(
+        self,
+        context,
+        check_records=KF_DEADLINE_CHECK_RECORDS,
+        reserve_ms=KF_FLUSH_RESERVE_MS,
+    ):
+        self.context = context
+        self.check_records = check_records
+        self.reserve_ms = reserve_ms
+        self.records = 0
+        self.chunk_started = time.perf_counter()
+
+    def out_of_time(self):
+        self.records += 1
+        if self.records % self.check_records:
+            return False
+        now = time.perf_counter()
+        chunk_ms = (now - self.chunk_started) * 1000
+        self.chunk_started = now
+        return self.context.get_remaining_time_in_millis() - self.reserve_ms < chunk_ms
+
+
+def process_log_events(data, skip, tags, deadline, decode_seconds):
+    # Aggregates the log events of a compressed CloudWatch Logs payload past
+    # the first skip ones. Returns None once they are all processed, or the
+    # number of events processed when time ran out, the batch so far emitted.
+    log_events = timed(
+        itertools.islice(iter_log_events(data), skip, None), decode_seconds
+    )
+    records = 0
+    batch = FlowLogBatch()
+    for message, timestamp in log_events:
+        batch.process_message(message, timestamp / 1000)
+        records += 1
+        if records % KF_S3_BATCH_RECORDS == 0:
+            emit_batch(batch, tags)
+            batch = FlowLogBatch()
+        if deadline.out_of_time():
+            emit_batch(batch, tags)
+            return skip + records
+    emit_batch(batch, tags)
+    return None
+
+
+def lambda_handler(event, context):
+    invocation_started = time.perf_counter()
+    credentials.prefetch()
+    tags = invocation_tags(context)
 
-    node_ip = compute_node_ip(event["logEvents"])
+    # event is a dict containing a base64 string gzipped. Payloads deferred
+    # by earlier invocations of the container go first, as (spill file name,
+    # compressed payload, events processed).
+    payloads = spill_queue.deferred()
+    payloads.append((None, base64.b64decode(event["awslogs"]["data"]), 0))
 
-    for event in event["logEvents"]:
-        message = event["message"]
-        if message[0] != "3":
-            unsupported_messages += 1
+    deadline = Deadline(context)
+    decode_seconds = [0.0]
+    parse_started = time.perf_counter()
+    for i, (name, data, skip) in enumerate(payloads):
+        try:
+            processed = process_log_events(data, skip, tags, deadline, decode_seconds)
+        except Exception as e:
+            if name is None:
+                raise
+            # Dropped rather than kept for a retry: it is processed first,
+            # so it would fail every later invocation of the container.
+            logger.error(f"ERROR Dropping deferred payload {name}: {e!r}")
+            spill_queue.remove_deferred(name, dropped=True)
+            continue
+        if processed is None:
+            if name is not None:
+                spill_queue.remove_deferred(name)
             continue
-        timestamp = event["timestamp"] / 1000
-        process_message(message, tags, timestamp, node_ip)
+        # The deferred payloads after this one are still in the spill queue,
+        # the invocation's own payload joins them if it was not reached.
+        spill_queue.defer(data, processed, name)
+        if i < len(payloads) - 1:
+            spill_queue.defer(payloads[-1][1], 0)
+        stats.increment(
+            "forwarder.deferred_payloads", value=len(payloads) - i, tags=tags
+        )
+        break
+    record_invocation(
+        tags,
+        decode=decode_seconds[0],
+        parse=time.perf_counter() - parse_started - decode_seconds[0],
+    )
 
-    if unsupported_messages:
-        logger.info("Unsupported vpc flowlog message type, please contact Kloudfuse")
-        stats.increment("unsupported_message", value=unsupported_messages, tags=tags)
+    flush_or_hold(tags, context)
+    _log_cold_start(invocation_started)
+
+
+class S3RangeReader(io.RawIOBase):
+    # Seekable, read-only view of an S3 object that fetches the bytes it is
+    # asked for with ranged GETs. Wrapped in a BufferedReader every GET covers
+    # KF_S3_RANGE_BYTES, so large objects are streamed instead of downloaded.
+    def __init__(self, client, bucket, key, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            size = client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size or not len(b):
+            return 0
+        end = min(self.pos + len(b), self.size) - 1
+        body = self.client.get_object(
+            Bucket=self.bucket, Key=self.key, Range="bytes=%d-%d" % (self.pos, end)
+        )["Body"].read()
+        b[: len(body)] = body
+        self.pos += len(body)
+        return len(body)
+
+
+def s3_client():
+    import boto3
+
+    return boto3.client("s3", endpoint_url=KF_S3_ENDPOINT_URL)
+
+
+def open_s3_object(client, bucket, key, size=None):
+    return io.BufferedReader(
+        S3RangeReader(client, bucket, key, size), buffer_size=KF_S3_RANGE_BYTES
+    )
+
+
+def _flow_log_text_lines(fileobj):
+    if fileobj.peek(2)[:2] == b"\x1f\x8b":
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    for line in io.TextIOWrapper(fileobj, encoding="utf-8"):
+        line = line.rstrip("\r\n")
+        if line:
+            yield line
+
+
+def _flow_log_parquet_rows(fileobj, batch_size=KF_S3_BATCH_RECORDS):
+    # Yields the LogFormat of the file, then one list of fields per row. Only
+    # the columns FlowRecord reads are loaded, like a text object's other
+    # fields they would be skipped anyway.
+    parquet = pq.ParquetFile(fileobj)
+    columns = [
+        name
+        for name in parquet.schema_arrow.names
+        if name.replace("_", "-") in FlowRecord.attribute_fields
+    ]
+    yield LogFormat.from_fields(columns)
+    for record_batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        values = [
+            pc.fill_null(pc.cast(column, pa.string()), "-").to_pylist()
+            for column in record_batch.columns
+        ]
+        for row in zip(*values):
+            yield list(row)
+
+
+def process_flow_log_object(fileobj, name, tags, batch_records=KF_S3_BATCH_RECORDS):
+    # Aggregates an S3-delivered flow log object into stats. fileobj is any
+    # buffered binary file: an S3 object from open_s3_object() or a local
+    # file, which keeps this testable without S3. Text objects, gzipped or
+    # not, start with a header line naming their fields, Parquet objects
+    # (.parquet) name them in their schema.
+    if name.endswith(".parquet"):
+        if pa is None:
+            raise ValueError("pyarrow is required to read Parquet flow logs")
+        rows = _flow_log_parquet_rows(fileobj)
+        object_format = next(rows)
+        process = FlowLogBatch.process_fields
+    else:
+        rows = _flow_log_text_lines(fileobj)
+        header = next(rows, "")
+        if header.split(" ", 1)[0] in FLOW_LOG_FIELDS:
+            object_format = LogFormat.from_fields(header.split(" "))
+        else:
+            object_format = log_format
+            rows = itertools.chain([header], rows)
+        process = FlowLogBatch.process_message
+
+    records = 0
+    batch = FlowLogBatch(log_format=object_format)
+    for row in rows:
+        process(batch, row)
+        records += 1
+        if records % batch_records == 0:
+            emit_batch(batch, tags)
+            batch = FlowLogBatch(log_format=object_format)
+    emit_batch(batch, tags)
+    return records
+
+
+def s3_lambda_handler(event, context):
+    # Entry point for S3 object-created notifications on the flow log bucket.
+    invocation_started = time.perf_counter()
+    credentials.prefetch()
+    tags = invocation_tags(context)
+    client = s3_client()
+
+    for record in event["Records"]:
+        bucket = record["s3"]["bucket"]["name"]
+        key = unquote_plus(record["s3"]["object"]["key"])
+        size = record["s3"]["object"].get("size")
+        with open_s3_object(client, bucket, key, size) as fileobj:
+            records = process_flow_log_object(fileobj, key, tags)
+        logger.info(f"INFO Processed {records} records from s3://{bucket}/{key}")
+    record_invocation(tags, parse=time.perf_counter() - invocation_started)
 
-    stats.flush()
+    flush_or_hold(tags, context)
+    _log_cold_start(invocation_started)